@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+"""
+Compare the key-indexed controller lookup of VmManager.get_vm_hardware with
+the linear scan it replaced, on synthetic device lists.
+
+    python3 benchmarks/device_controller.py [device_count ...]
+"""
+
+import os
+import sys
+import timeit
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from providers.vmware.vm_manager import VmManager
+
+
+DEVICE_COUNTS = [100, 500, 2000]
+REPEAT = 5
+
+
+def make_devices(count):
+    """
+    A PCI controller with SCSI controllers, and `count` disks spread over
+    them, listed after the controllers like vSphere does.
+    """
+    def device(key, controller_key, bus_number=0):
+        return SimpleNamespace(
+            key=key,
+            controllerKey=controller_key,
+            busNumber=bus_number,
+            deviceInfo=SimpleNamespace(label="Device %d" % key),
+            slotInfo=None
+        )
+
+    devices = [device(100, None)]
+    devices += [device(1000 + i, 100, i) for i in range(4)]
+    devices += [device(2000 + i, 1000 + i % 4) for i in range(count)]
+    return devices
+
+
+def linear_scan(device, device_list):
+    # The lookup get_vm_hardware used before devices were indexed by key
+    if device.controllerKey is None:
+        return None
+
+    ctlr = next(dev for dev in device_list if dev.key == device.controllerKey)
+    controller = {
+        "type": type(ctlr).__name__.split(".")[-1],
+        "key": ctlr.key,
+        "name": ctlr.deviceInfo.label,
+        "bus_number": ctlr.busNumber,
+        "controller": linear_scan(ctlr, device_list)
+    }
+
+    if ctlr.slotInfo is not None:
+        controller["pci_slot_number"] = ctlr.slotInfo.pciSlotNumber
+
+    return controller
+
+
+def resolve_linear(device_list):
+    return [linear_scan(device, device_list) for device in device_list]
+
+
+def resolve_indexed(vm_manager, device_list):
+    devices = {device.key: device for device in device_list}
+    controllers = {}
+    return [vm_manager._get_device_controller(device, devices, controllers) for device in device_list]
+
+
+def main():
+    counts = [int(arg) for arg in sys.argv[1:]] or DEVICE_COUNTS
+    # The lookup doesn't use the connection, so none is opened
+    vm_manager = VmManager.__new__(VmManager)
+
+    print("%8s %12s %12s %8s" % ("devices", "linear (ms)", "indexed (ms)", "speedup"))
+    for count in counts:
+        device_list = make_devices(count)
+        if resolve_linear(device_list) != resolve_indexed(vm_manager, device_list):
+            raise Exception("Lookups disagree with %d devices" % count)
+
+        number = max(1, 20000 // count)
+        linear = min(timeit.repeat(lambda: resolve_linear(device_list), number=number, repeat=REPEAT)) / number
+        indexed = min(timeit.repeat(lambda: resolve_indexed(vm_manager, device_list), number=number, repeat=REPEAT)) / number
+        print("%8d %12.3f %12.3f %7.1fx" % (count, linear * 1000, indexed * 1000, linear / indexed))
+
+
+if __name__ == '__main__':
+    main()
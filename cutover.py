@@ -0,0 +1,113 @@
+import contextvars
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import threading
+
+
+# From sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_CLOEXEC = 0o2000000
+
+
+class CutoverWatcher:
+    """
+    Watches for the cutover file with inotify and sets an event as soon as it
+    appears, so that the runner doesn't have to poll for it. Falls back to
+    checking for the file every POLL_INTERVAL when inotify isn't available.
+    """
+
+    POLL_INTERVAL = 1 # 1 second
+
+    def __init__(self, path):
+        self._path = path
+        self._event = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+
+    @property
+    def event(self):
+        return self._event
+
+
+    def _inotify_init(self):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        fd = libc.inotify_init1(IN_CLOEXEC)
+        if fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        wd = libc.inotify_add_watch(fd, os.path.dirname(self._path).encode(), IN_CREATE | IN_MOVED_TO | IN_CLOSE_WRITE)
+        if wd < 0:
+            os.close(fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+        return fd
+
+
+    def _watch_inotify(self, fd):
+        name = os.path.basename(self._path).encode()
+        try:
+            while not self._stopped.is_set() and not self._event.is_set():
+                if not select.select([fd], [], [], self.POLL_INTERVAL)[0]:
+                    continue
+                data = os.read(fd, 4096)
+                position = 0
+                while position < len(data):
+                    wd, mask, cookie, length = struct.unpack_from("iIII", data, position)
+                    position += 16
+                    if data[position:position + length].rstrip(b"\0") == name:
+                        self._set()
+                    position += length
+        finally:
+            os.close(fd)
+
+
+    def _watch_polling(self):
+        while not self._stopped.wait(self.POLL_INTERVAL):
+            if os.path.exists(self._path):
+                self._set()
+                return
+
+
+    def _set(self):
+        if not self._event.is_set():
+            logging.info("Cutover requested through %s", self._path)
+            self._event.set()
+
+
+    def start(self):
+        try:
+            fd = self._inotify_init()
+            target = lambda: self._watch_inotify(fd)
+        except (OSError, AttributeError) as err:
+            logging.warning("Can't watch cutover file with inotify, polling instead: %s", err)
+            target = self._watch_polling
+
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(target,), name="cutover-watcher", daemon=True)
+        self._thread.start()
+
+        # The file may have been created before the watch was set up
+        if os.path.exists(self._path):
+            self._set()
+
+
+    def requested(self):
+        return self._event.is_set()
+
+
+    def wait(self, timeout):
+        """
+        Sleep for `timeout` seconds, or until cutover is requested.
+        Return whether cutover is requested.
+        """
+        return self._event.wait(timeout)
+
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
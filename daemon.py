@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import signal
+import socket
+import logging
+import threading
+from importlib import import_module
+
+from runner import ConversionHostRunner
+from providers.sessions import session_pool
+
+
+class ConversionHostDaemon:
+    """
+    Runs migrations for the requests it receives on a Unix socket, each one
+    in its own thread. Provider modules are imported once and provider
+    sessions are shared between migrations through the session pool.
+
+    A client sends a request as a single line of JSON and gets back a line
+    of JSON, with either the files of the migration or an error. The
+    connection is closed once the migration has started.
+
+    Once stopped, no request is accepted anymore and the running migrations
+    are interrupted and waited for, so that they clean up after themselves.
+    """
+
+    SOCKET_PATH = "/run/conversion-host/runner.sock"
+    LOG_FILE = "/var/log/conversion-host/daemon.log"
+    LOG_LEVEL = logging.DEBUG
+    POLL_INTERVAL = 1 # 1 second
+    SESSION_IDLE_TIMEOUT = 300 # 5 minutes
+    PROVIDERS = ["vmware", "ovirt", "openstack"]
+
+    def __init__(self, socket_path=SOCKET_PATH):
+        self._socket_path = socket_path
+        self._migrations = {}
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+
+        log_dir = os.path.dirname(self.LOG_FILE)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        log_format = '%(asctime)s:%(levelname)s: %(message)s (%(module)s:%(lineno)d)'
+        logging.basicConfig(filename=self.LOG_FILE, format=log_format, level=self.LOG_LEVEL)
+
+        session_pool.idle_timeout = self.SESSION_IDLE_TIMEOUT
+
+
+    def _import_providers(self):
+        # Importing the SDKs takes a while, so it is done once upfront
+        for provider in self.PROVIDERS:
+            for module in ["vm_manager", "guestfs_helper"]:
+                try:
+                    import_module("providers.%s.%s" % (provider, module))
+                except ImportError as err:
+                    logging.warning("Provider %s is not available: %s", provider, err)
+
+
+    def _reply(self, conn, response):
+        conn.sendall((json.dumps(response) + "\n").encode("utf-8"))
+
+
+    def _handle(self, conn):
+        try:
+            with conn.makefile("r", encoding="utf-8") as f:
+                request = json.loads(f.readline())
+
+            with self._lock:
+                if self._stopped.is_set():
+                    raise Exception("The daemon is stopping")
+                if request.get("vm_name") in self._migrations:
+                    raise Exception("A migration of '%s' is already running" % request["vm_name"])
+                # The runner is known once created
+                self._migrations[request.get("vm_name")] = None
+
+            try:
+                runner = ConversionHostRunner(request, shared_logging=True)
+                with self._lock:
+                    self._migrations[request["vm_name"]] = runner
+                    if self._stopped.is_set():
+                        runner.interrupt()
+                logging.info("Starting migration of %s", request["vm_name"])
+                self._reply(conn, {
+                    "vm_name": request["vm_name"],
+                    "log_file": runner._log_file,
+                    "state_file": runner._state_file,
+                    "limits_file": runner._limits_file,
+                    "cutover_file": runner._cutover_file
+                })
+                conn.close()
+                runner.run()
+                logging.info("Migration of %s finished", request["vm_name"])
+            finally:
+                with self._lock:
+                    del self._migrations[request.get("vm_name")]
+
+        except Exception as err:
+            logging.error("Migration failed: %s", err)
+            try:
+                self._reply(conn, {"error": str(err)})
+            except OSError:
+                # The client is already gone, or got its reply
+                pass
+
+        finally:
+            conn.close()
+            session_pool.expire()
+
+
+    def stop(self):
+        logging.info("Stopping, no more migrations will be started")
+        with self._lock:
+            self._stopped.set()
+            runners = [runner for runner in self._migrations.values() if runner is not None]
+        for runner in runners:
+            runner.interrupt()
+
+
+    def serve(self):
+        self._import_providers()
+
+        if os.path.exists(self._socket_path):
+            os.remove(self._socket_path)
+        socket_dir = os.path.dirname(self._socket_path)
+        if not os.path.isdir(socket_dir):
+            os.makedirs(socket_dir)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self._socket_path)
+        os.chmod(self._socket_path, 0o600)
+        server.listen()
+        # Wake up regularly to notice a stop and to close the sessions left
+        # idle
+        server.settimeout(self.POLL_INTERVAL)
+        logging.info("Listening on %s", self._socket_path)
+
+        threads = []
+        try:
+            while not self._stopped.is_set():
+                try:
+                    conn, _ = server.accept()
+                except socket.timeout:
+                    session_pool.expire()
+                    threads = [thread for thread in threads if thread.is_alive()]
+                    continue
+                conn.settimeout(None)
+                # Migrations aren't daemon threads, so that they are never
+                # killed halfway without cleaning up
+                thread = threading.Thread(target=self._handle, args=(conn,))
+                thread.start()
+                threads.append(thread)
+        finally:
+            server.close()
+            os.remove(self._socket_path)
+            if not self._stopped.is_set():
+                self.stop()
+            if len(threads) > 0:
+                logging.info("Waiting for %d running migrations", len(threads))
+            for thread in threads:
+                thread.join()
+            session_pool.close()
+
+
+def main():
+    daemon = ConversionHostDaemon(*sys.argv[1:2])
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda signum, frame: daemon.stop())
+    daemon.serve()
+
+
+if __name__ == '__main__':
+    main()
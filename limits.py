@@ -0,0 +1,156 @@
+import contextvars
+import json
+import logging
+import multiprocessing
+import os
+import threading
+
+
+class LimitsWatcher:
+    """
+    Applies the limits of the limits file while the migration runs. The file
+    is a JSON object with optional 'cpu' (percentage of the host CPUs) and
+    'network' (bytes per second) keys, and can be changed at any time.
+
+    The network limit is enforced by the source transfer, which reads it from
+    state.throttling. The CPU limit is enforced by a cgroup that the nbdkit
+    and virt-v2v children are started in.
+    """
+
+    POLL_INTERVAL = 1 # 1 second
+    CGROUP_ROOT = "/sys/fs/cgroup/conversion-host"
+    CPU_PERIOD = 100000 # 100ms
+
+    def __init__(self, path, state, name):
+        self._path = path
+        self._state = state
+        self._cgroup = "%s/%s" % (self.CGROUP_ROOT, name)
+        self._mtime = None
+        self._stopped = threading.Event()
+        self._thread = None
+
+
+    def _setup_cgroup(self):
+        created = False
+        try:
+            if not os.path.isdir(self.CGROUP_ROOT):
+                os.mkdir(self.CGROUP_ROOT)
+            with open("%s/cgroup.subtree_control" % self.CGROUP_ROOT, "w") as f:
+                f.write("+cpu")
+            if not os.path.isdir(self._cgroup):
+                os.mkdir(self._cgroup)
+                created = True
+            if not os.path.exists("%s/cpu.max" % self._cgroup):
+                raise Exception("cpu controller is not enabled")
+        except Exception as err:
+            logging.warning("Can't set up cgroup %s, CPU limits won't be applied: %s", self._cgroup, err)
+            if created:
+                try:
+                    os.rmdir(self._cgroup)
+                except OSError as err:
+                    logging.warning("Can't remove cgroup %s: %s", self._cgroup, err)
+            return
+        logging.info("Children processes are started in cgroup %s", self._cgroup)
+        self._state.cgroup = self._cgroup
+
+
+    def _read(self):
+        try:
+            mtime = os.stat(self._path).st_mtime
+        except FileNotFoundError:
+            mtime = None
+        if mtime == self._mtime:
+            return None
+        self._mtime = mtime
+
+        if mtime is None:
+            return {}
+        try:
+            with open(self._path) as f:
+                limits = json.load(f)
+        except ValueError as err:
+            logging.error("Ignoring invalid limits file %s: %s", self._path, err)
+            return None
+        if not isinstance(limits, dict):
+            logging.error("Ignoring invalid limits file %s: it isn't a JSON object", self._path)
+            return None
+        return limits
+
+
+    def _apply_cpu(self, cpu):
+        if self._state.cgroup is None:
+            return None
+        if cpu is None:
+            cpu_max = "max %d" % self.CPU_PERIOD
+        else:
+            quota = int(self.CPU_PERIOD * multiprocessing.cpu_count() * cpu / 100)
+            cpu_max = "%d %d" % (max(quota, 1000), self.CPU_PERIOD)
+        with open("%s/cpu.max" % self._cgroup, "w") as f:
+            f.write(cpu_max)
+        return cpu
+
+
+    def _apply(self, limits):
+        cpu = limits.get("cpu")
+        network = limits.get("network")
+        try:
+            if cpu is not None and not 0 < cpu <= 100:
+                logging.error("Ignoring CPU limit %s, it must be a percentage", cpu)
+                cpu = None
+            if network is not None and network <= 0:
+                logging.error("Ignoring network limit %s, it must be positive", network)
+                network = None
+        except (ValueError, TypeError) as err:
+            logging.error("Ignoring invalid limits %s, keeping the current ones: %s", limits, err)
+            return
+
+        try:
+            cpu = self._apply_cpu(cpu)
+        except OSError as err:
+            logging.error("Can't apply CPU limit %s: %s", cpu, err)
+            cpu = self._state.throttling["cpu"]
+
+        logging.info("Applying limits: cpu=%s network=%s", cpu, network)
+        with self._state.lock:
+            self._state.throttling = {
+                "cpu": cpu,
+                "network": network
+            }
+        self._state.flush()
+
+
+    def _watch(self):
+        while not self._stopped.wait(self.POLL_INTERVAL):
+            try:
+                limits = self._read()
+                if limits is not None:
+                    self._apply(limits)
+            except Exception as err:
+                # Keep watching, the file may be fixed later on
+                logging.error("Can't apply limits from %s: %s", self._path, err)
+
+
+    def _remove_cgroup(self):
+        if self._state.cgroup is None:
+            return
+        try:
+            os.rmdir(self._cgroup)
+        except OSError as err:
+            logging.warning("Can't remove cgroup %s: %s", self._cgroup, err)
+        self._state.cgroup = None
+
+
+    def start(self):
+        self._setup_cgroup()
+        limits = self._read()
+        if limits is not None:
+            self._apply(limits)
+        self._thread = threading.Thread(target=contextvars.copy_context().run, args=(self._watch,), name="limits-watcher", daemon=True)
+        self._thread.start()
+
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None:
+            self._thread.join()
+        self._remove_cgroup()
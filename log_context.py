@@ -0,0 +1,22 @@
+import contextvars
+import logging
+
+
+# Log file of the migration the current code runs for. Threads don't
+# inherit it: they have to be started in a copy of the caller's context.
+migration = contextvars.ContextVar("migration", default=None)
+
+
+class MigrationLogFilter(logging.Filter):
+    """
+    Only lets through the records of one migration, when several of them
+    log from the same process.
+    """
+
+    def __init__(self, log_file):
+        super().__init__()
+        self._log_file = log_file
+
+
+    def filter(self, record):
+        return migration.get() == self._log_file
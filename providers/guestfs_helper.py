@@ -3,6 +3,17 @@ import logging
 import subprocess
 from importlib import import_module
 
+
+def cgroup_cmd(cmd, cgroup):
+    """
+    Wrap a command so that it moves itself into a cgroup before running.
+    Its children, like the ones sudo starts, are then in the cgroup too.
+    """
+    if cgroup is None:
+        return cmd
+    return ["sh", "-c", 'echo $$ > "$0/cgroup.procs" && exec "$@"', cgroup] + cmd
+
+
 class GuestfsHelper:
     def __init__(self, request, side, state):
         self._request = request
@@ -61,6 +72,26 @@ class GuestfsHelper:
         return minidom.parseString(ET.tostring(xml, "utf-8")).toprettyxml(indent="    ")
 
 
+    def nbd_expose_disk(self, disk_spec, **kwargs):
+        return self._guestfs_helper.nbd_expose_disk(disk_spec, **kwargs)
+
+
+    def nbd_connect(self, disk_spec, connections=1, **kwargs):
+        return self._guestfs_helper.nbd_connect(disk_spec, connections, **kwargs)
+
+
+    def nbd_disconnect(self, disk_spec):
+        self._guestfs_helper.nbd_disconnect(disk_spec)
+
+
+    def nbd_release_snapshot(self, snapshot_moref):
+        self._guestfs_helper.nbd_release_snapshot(snapshot_moref)
+
+
+    def nbd_close_connections(self):
+        self._guestfs_helper.nbd_close_connections()
+
+
     def nbd_process_aio_requests(self, nbd_handle):
         self._guestfs_helper.nbd_process_aio_requests(nbd_handle)
 
@@ -91,7 +122,7 @@ class GuestfsHelper:
 
         with open(log_file, 'w') as log:
             proc = subprocess.Popen(
-                virtv2v_cmd,
+                cgroup_cmd(virtv2v_cmd, self._state.cgroup),
                 stdout=log,
                 stderr=subprocess.STDOUT,
                 text=True
@@ -14,6 +14,26 @@ class GuestfsHelper:
         pass
 
 
+    def nbd_expose_disk(self, disk_spec, **kwargs):
+        pass
+
+
+    def nbd_connect(self, disk_spec, connections=1, **kwargs):
+        pass
+
+
+    def nbd_disconnect(self, disk_spec):
+        pass
+
+
+    def nbd_release_snapshot(self, snapshot_moref):
+        pass
+
+
+    def nbd_close_connections(self):
+        pass
+
+
     def nbd_process_aio_requests(self, nbd_handle):
         pass
 
@@ -5,29 +5,45 @@ from cinderclient import client as cinder_client
 from cinderclient.v2 import volume_transfers as cinder_volume_transfers
 from neutronclient.v2_0 import client as neutron_client
 
+from providers.sessions import session_pool
+
 class VmManager:
     def __init__(self, request, side, state):
         self._request = request
         self._side = side
         self._state = state
         self._connection = self._connect()
-        self._init_os_clients(self._connection)
-
-
-    def __del__(self):
-        self._disconnect()
+        try:
+            self._init_os_clients(self._connection)
+        except:
+            self.close()
+            raise
 
 
     def _connect(self):
-        connection = {
-            "source": self._get_source_keystone_session,
-            "destination": self._get_destination_keystone_session
-        }
+        self._session_keys = []
+        connection = {}
+        try:
+            for name, authentication, project, get_session in [
+                ("source", self._request['destination']['authentication'], self._request['conversion_host_project'], self._get_source_keystone_session),
+                ("destination", self._request['destination']['authentication']['manager'], self._request['destination']['project'], self._get_destination_keystone_session)
+            ]:
+                session_key = ("openstack", authentication['url'], authentication['username'], project)
+                connection[name] = session_pool.acquire(session_key, get_session)
+                self._session_keys.append(session_key)
+        except:
+            # Don't keep the first session if the second can't be opened
+            self.close()
+            raise
         return connection
 
 
-    def _disconnect(self):
-        pass
+    def close(self):
+        """
+        Hand the sessions back to the pool. Closing twice is harmless.
+        """
+        while self._session_keys:
+            session_pool.release(self._session_keys.pop())
 
 
     def _get_source_keystone_session(self):
@@ -139,7 +155,7 @@ class VmManager:
         pass
 
 
-    def sync_disks(self, vm_id, disks_mapping, guestfs_helper, sync_index, last_sync):
+    def sync_disks(self, vm_id, disks_mapping, guestfs_helper, sync_index, last_sync, interrupt_event=None):
         pass
 
 
@@ -4,17 +4,21 @@ import ovirtsdk4.types
 import subprocess
 import time
 
+from providers.sessions import session_pool
+
 class VmManager:
 
     def __init__(self, request, side, state):
         self._request = request
         self._side = side
         self._state = state
-        self._connection = self._connect()
-
-
-    def __del__(self):
-        self._disconnect()
+        session_key = (
+            "ovirt",
+            self._request[self._side]["authentication"]["manager"]["hostname"],
+            self._request[self._side]["authentication"]["manager"]["username"]
+        )
+        self._connection = session_pool.acquire(session_key, self._connect, lambda conn: conn.close())
+        self._session_key = session_key
 
 
     def _connect(self):
@@ -28,11 +32,14 @@ class VmManager:
         return conn
 
 
-    def _disconnect(self):
-        try:
-            self._connection.close()
-        except:
-            pass
+    def close(self):
+        """
+        Hand the session back to the pool. Closing twice is harmless.
+        """
+        if self._session_key is None:
+            return
+        session_pool.release(self._session_key)
+        self._session_key = None
 
 
     def _find_vm_by_id(self, vm_id):
@@ -292,7 +299,7 @@ class VmManager:
         pass
 
 
-    def sync_disks(self, vm_id, disks_mapping, guestfs_helper, sync_index, last_sync):
+    def sync_disks(self, vm_id, disks_mapping, guestfs_helper, sync_index, last_sync, interrupt_event=None):
         pass
 
 
@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+
+
+class SessionPool:
+    """
+    Provider sessions shared by all the migrations of a process, indexed by
+    (provider, endpoint, user) and reference counted. A session that nobody
+    uses anymore is closed after `idle_timeout` seconds, so that the next
+    migration to the same endpoint can reuse it meanwhile.
+    """
+
+    def __init__(self, idle_timeout=0):
+        self.idle_timeout = idle_timeout
+        self._lock = threading.Lock()
+        self._sessions = {}
+
+
+    def acquire(self, key, connect, disconnect=None):
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                session["references"] += 1
+                logging.debug("Reusing session to %s (%d references)", key[:2], session["references"])
+                return session["connection"]
+
+        # Connecting may take a while, other sessions remain usable
+        logging.debug("Opening session to %s", key[:2])
+        connection = connect()
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is not None:
+                # Another migration connected first, keep its session
+                session["references"] += 1
+            else:
+                self._sessions[key] = {
+                    "connection": connection,
+                    "disconnect": disconnect,
+                    "references": 1,
+                    "idle_since": None
+                }
+                return connection
+        self._close(key, connection, disconnect)
+        return session["connection"]
+
+
+    def release(self, key):
+        with self._lock:
+            session = self._sessions[key]
+            session["references"] -= 1
+            if session["references"] > 0:
+                return
+            session["idle_since"] = time.monotonic()
+        self.expire()
+
+
+    def _close(self, key, connection, disconnect):
+        logging.debug("Closing session to %s", key[:2])
+        if disconnect is None:
+            return
+        try:
+            disconnect(connection)
+        except Exception as err:
+            logging.warning("Closing session to %s failed: %s", key[:2], err)
+
+
+    def expire(self, idle_timeout=None):
+        if idle_timeout is None:
+            idle_timeout = self.idle_timeout
+        now = time.monotonic()
+        with self._lock:
+            expired = [
+                (key, self._sessions.pop(key))
+                for key, session in list(self._sessions.items())
+                if session["references"] == 0 and now - session["idle_since"] >= idle_timeout
+            ]
+        for key, session in expired:
+            self._close(key, session["connection"], session["disconnect"])
+
+
+    def close(self):
+        # Sessions still referenced are left to their users
+        self.expire(0)
+
+
+session_pool = SessionPool()
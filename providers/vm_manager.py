@@ -6,6 +6,10 @@ class VmManager:
         self._vm_manager = import_module("providers.%s.vm_manager" % request[side]["type"]).VmManager(request, side, state)
 
 
+    def close(self):
+        self._vm_manager.close()
+
+
     def get_vm_hardware(self, vm_id):
         return self._vm_manager.get_vm_hardware(vm_id)
 
@@ -26,6 +30,14 @@ class VmManager:
         self._vm_manager.remove_all_snapshots(vm_id)
 
 
+    def adopt_snapshot(self, snapshot):
+        self._vm_manager.adopt_snapshot(snapshot)
+
+
+    def release_snapshot(self):
+        self._vm_manager.release_snapshot()
+
+
     def get_local_disk_path(self, disk_spec):
         return self._vm_manager.get_local_disk_path(disk_spec)
 
@@ -45,8 +57,8 @@ class VmManager:
         self._vm_manager.enable_change_block_tracking(vm_id)
 
 
-    def sync_disks(self, vm_id, disks_mappings, guestfs_helper, sync_index, last_sync):
-        self._vm_manager.sync_disks(vm_id, disks_mappings, guestfs_helper, sync_index, last_sync)
+    def sync_disks(self, vm_id, disks_mappings, guestfs_helper, sync_index, last_sync, interrupt_event=None):
+        return self._vm_manager.sync_disks(vm_id, disks_mappings, guestfs_helper, sync_index, last_sync, interrupt_event)
 
 
     def add_nic_to_vm(self, vm_id, nic_spec):
@@ -0,0 +1,150 @@
+import ctypes
+import ctypes.util
+import errno
+import fcntl
+import logging
+import mmap
+import os
+import stat
+import struct
+
+
+# From linux/fs.h and linux/falloc.h
+BLKZEROOUT = 0x127f
+FALLOC_FL_KEEP_SIZE = 0x01
+FALLOC_FL_PUNCH_HOLE = 0x02
+FALLOC_FL_ZERO_RANGE = 0x10
+
+SECTOR_SIZE = 512
+ZERO_BUFFER = bytes(1 << 20)
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_longlong, ctypes.c_longlong]
+_libc.memcmp.argtypes = [ctypes.c_void_p, ctypes.c_void_p, ctypes.c_size_t]
+
+
+def buffers_equal(a, b):
+    """
+    Compare two writable buffers of the same length with memcmp, which is
+    much faster than comparing memoryviews item by item.
+    """
+    if len(a) != len(b):
+        return False
+    if len(a) == 0:
+        return True
+    a_array = (ctypes.c_char * len(a)).from_buffer(a)
+    b_array = (ctypes.c_char * len(b)).from_buffer(b)
+    try:
+        return _libc.memcmp(ctypes.addressof(a_array), ctypes.addressof(b_array), len(a)) == 0
+    finally:
+        del a_array, b_array
+
+
+class BufferPool:
+    """
+    Fixed set of page-aligned buffers, recycled between NBD reads
+    """
+
+    def __init__(self, count, size):
+        self._count = count
+        self._size = size
+        self._free = []
+        self._buffers = []
+
+
+    @property
+    def size(self):
+        return self._size
+
+
+    def available(self):
+        return len(self._free) + self._count - len(self._buffers)
+
+
+    def acquire(self, length):
+        if length > self._size:
+            raise Exception("Requested length %d B exceeds buffer size %d B" % (length, self._size))
+        if len(self._free) == 0:
+            # Buffers are only allocated when needed, so that a pool sized for
+            # the largest settings doesn't cost memory until they are used.
+            if len(self._buffers) == self._count:
+                raise Exception("No free buffer left in pool")
+            self._buffers.append(mmap.mmap(-1, self._size))
+            self._free.append(self._buffers[-1])
+            logging.debug("Allocated buffer %d/%d of %d B", len(self._buffers), self._count, self._size)
+        buf = self._free.pop()
+        return buf, memoryview(buf)[:length]
+
+
+    def release(self, buf, view):
+        view.release()
+        self._free.append(buf)
+
+
+    def close(self):
+        for buf in self._buffers:
+            try:
+                buf.close()
+            except BufferError:
+                # Still referenced by a pending read, left to the GC
+                pass
+        self._free = []
+        self._buffers = []
+
+
+class Zeroer:
+    """
+    Zeroes ranges of a destination disk, letting the kernel do the work when
+    it can: BLKZEROOUT on block devices, fallocate on regular files. Writing
+    a shared zero buffer is the last resort.
+    """
+
+    UNSUPPORTED_ERRNOS = [errno.EOPNOTSUPP, errno.ENOTTY, errno.ENOSYS]
+
+    def __init__(self, fd):
+        self._fd = fd
+        if stat.S_ISBLK(os.fstat(fd).st_mode):
+            self._methods = [self._zero_blkzeroout]
+        else:
+            self._methods = [self._zero_punch_hole, self._zero_zero_range]
+
+
+    def _zero_blkzeroout(self, offset, length):
+        if offset % SECTOR_SIZE or length % SECTOR_SIZE:
+            raise OSError(errno.EINVAL, "Range is not sector aligned")
+        fcntl.ioctl(self._fd, BLKZEROOUT, struct.pack("QQ", offset, length))
+
+
+    def _fallocate(self, mode, offset, length):
+        if _libc.fallocate(self._fd, mode, offset, length) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+
+    def _zero_punch_hole(self, offset, length):
+        self._fallocate(FALLOC_FL_PUNCH_HOLE | FALLOC_FL_KEEP_SIZE, offset, length)
+
+
+    def _zero_zero_range(self, offset, length):
+        self._fallocate(FALLOC_FL_ZERO_RANGE | FALLOC_FL_KEEP_SIZE, offset, length)
+
+
+    def _zero_write(self, offset, length):
+        view = memoryview(ZERO_BUFFER)
+        count = 0
+        while count < length:
+            count += os.pwrite(self._fd, view[:min(length - count, len(ZERO_BUFFER))], offset + count)
+
+
+    def zero(self, offset, length):
+        for method in list(self._methods):
+            try:
+                method(offset, length)
+                return
+            except OSError as err:
+                if err.errno in self.UNSUPPORTED_ERRNOS:
+                    logging.debug("Zeroing with %s is not supported: %s", method.__name__, err)
+                    self._methods.remove(method)
+                elif err.errno != errno.EINVAL:
+                    raise
+        self._zero_write(offset, length)
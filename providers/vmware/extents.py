@@ -0,0 +1,219 @@
+import bisect
+import collections
+import json
+import os
+import tempfile
+
+
+Extent = collections.namedtuple("Extent", ["start", "length"])
+
+
+def coalesce_extents(extents, gap=0):
+    """
+    Sort extents and merge those that overlap, touch or are less than `gap`
+    bytes apart. Reading a small unchanged gap costs less than an extra
+    request round trip.
+    """
+    merged = []
+    for extent in sorted(extents, key=lambda e: e.start):
+        if len(merged) > 0 and extent.start <= merged[-1].start + merged[-1].length + gap:
+            end = max(merged[-1].start + merged[-1].length, extent.start + extent.length)
+            merged[-1] = Extent(merged[-1].start, end - merged[-1].start)
+        else:
+            merged.append(Extent(extent.start, extent.length))
+    return merged
+
+
+def merge_blocks(blocks, mask):
+    """
+    Merge contiguous blocks whose flags are the same for the bits in `mask`,
+    so that the read plan is made of the largest sequential reads possible.
+    """
+    merged = []
+    for block in sorted(blocks, key=lambda b: b["offset"]):
+        if len(merged) > 0 \
+                and block["offset"] == merged[-1]["offset"] + merged[-1]["length"] \
+                and block["flags"] & mask == merged[-1]["flags"] & mask:
+            merged[-1]["length"] += block["length"]
+        else:
+            merged.append(dict(block))
+    return merged
+
+
+def split_blocks(blocks, count):
+    """
+    Split blocks into `count` stripes of contiguous blocks holding roughly
+    the same number of bytes, cutting blocks at stripe boundaries.
+    """
+    stripe_len = -(-sum(b["length"] for b in blocks) // count)
+    stripes = [[]]
+    remaining = stripe_len
+    for block in blocks:
+        offset = block["offset"]
+        end = block["offset"] + block["length"]
+        while offset < end:
+            if remaining == 0:
+                stripes.append([])
+                remaining = stripe_len
+            length = min(end - offset, remaining)
+            stripes[-1].append({
+                "offset": offset,
+                "length": length,
+                "flags": block["flags"]
+            })
+            offset += length
+            remaining -= length
+    return stripes
+
+
+def add_range(ranges, start, length):
+    """
+    Add [start, start + length[ to a sorted list of disjoint [start, length]
+    ranges, merging it with the ranges it overlaps or touches.
+    """
+    end = start + length
+    index = bisect.bisect_left(ranges, [start, 0])
+    if index > 0 and ranges[index - 1][0] + ranges[index - 1][1] >= start:
+        index -= 1
+    while index < len(ranges) and ranges[index][0] <= end:
+        start = min(start, ranges[index][0])
+        end = max(end, ranges[index][0] + ranges[index][1])
+        ranges.pop(index)
+    ranges.insert(index, [start, end - start])
+
+
+def subtract_ranges(extents, ranges):
+    """
+    Return the parts of extents that aren't covered by a sorted list of
+    disjoint [start, length] ranges.
+    """
+    remaining = []
+    for extent in extents:
+        position = extent.start
+        end = extent.start + extent.length
+        index = bisect.bisect_right(ranges, [position, 0])
+        if index > 0 and ranges[index - 1][0] + ranges[index - 1][1] > position:
+            index -= 1
+        while index < len(ranges) and ranges[index][0] < end:
+            if ranges[index][0] > position:
+                remaining.append(Extent(position, ranges[index][0] - position))
+            position = max(position, ranges[index][0] + ranges[index][1])
+            index += 1
+        if position < end:
+            remaining.append(Extent(position, end - position))
+    return remaining
+
+
+def clip_extents(extents, start, end):
+    """
+    Return the parts of extents that are within [start, end[.
+    """
+    clipped = []
+    for extent in extents:
+        clipped_start = max(extent.start, start)
+        clipped_end = min(extent.start + extent.length, end)
+        if clipped_start < clipped_end:
+            clipped.append(Extent(clipped_start, clipped_end - clipped_start))
+    return clipped
+
+
+class AllocationMap:
+    """
+    Allocation status of a disk, as a sorted list of non-overlapping blocks
+    with their NBD block status flags. It is saved in the work directory so
+    that block status queries can be skipped for ranges that haven't changed
+    since they were last queried.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._blocks = []
+        if os.path.exists(path):
+            with open(path) as f:
+                self._blocks = [
+                    {"offset": o, "length": l, "flags": fl}
+                    for o, l, fl in json.load(f)
+                ]
+        # Block offsets, kept alongside the blocks for bisection
+        self._offsets = [b["offset"] for b in self._blocks]
+
+
+    def _first_overlapping(self, start):
+        index = bisect.bisect_right(self._offsets, start)
+        if index > 0 and self._blocks[index - 1]["offset"] + self._blocks[index - 1]["length"] > start:
+            index -= 1
+        return index
+
+
+    def invalidate(self, start, length):
+        end = start + length
+        index = self._first_overlapping(start)
+        kept = []
+        while index < len(self._blocks) and self._blocks[index]["offset"] < end:
+            block = self._blocks.pop(index)
+            self._offsets.pop(index)
+            if block["offset"] < start:
+                kept.append({"offset": block["offset"], "length": start - block["offset"], "flags": block["flags"]})
+            if block["offset"] + block["length"] > end:
+                kept.append({"offset": end, "length": block["offset"] + block["length"] - end, "flags": block["flags"]})
+        self._blocks[index:index] = kept
+        self._offsets[index:index] = [b["offset"] for b in kept]
+
+
+    def update(self, blocks):
+        for block in blocks:
+            self.invalidate(block["offset"], block["length"])
+            index = self._first_overlapping(block["offset"])
+            self._blocks.insert(index, dict(block))
+            self._offsets.insert(index, block["offset"])
+
+
+    def missing(self, start, length):
+        """
+        Return the (start, length) ranges of [start, start + length[ that
+        have no known allocation status.
+        """
+        end = start + length
+        ranges = []
+        position = start
+        index = self._first_overlapping(start)
+        while index < len(self._blocks) and self._blocks[index]["offset"] < end:
+            block = self._blocks[index]
+            if block["offset"] > position:
+                ranges.append((position, block["offset"] - position))
+            position = max(position, block["offset"] + block["length"])
+            index += 1
+        if position < end:
+            ranges.append((position, end - position))
+        return ranges
+
+
+    def blocks(self, start, length):
+        end = start + length
+        blocks = []
+        index = self._first_overlapping(start)
+        while index < len(self._blocks) and self._blocks[index]["offset"] < end:
+            block = self._blocks[index]
+            offset = max(start, block["offset"])
+            blocks.append({
+                "offset": offset,
+                "length": min(end, block["offset"] + block["length"]) - offset,
+                "flags": block["flags"]
+            })
+            index += 1
+        return blocks
+
+
+    def save(self):
+        tmp_fd, tmp_path = tempfile.mkstemp(
+            dir = os.path.dirname(self._path),
+            prefix = ".%s." % os.path.basename(self._path),
+            suffix = '.tmp'
+        )
+        try:
+            with os.fdopen(tmp_fd, 'w') as fd:
+                json.dump([[b["offset"], b["length"], b["flags"]] for b in self._blocks], fd)
+            os.replace(tmp_path, self._path)
+        except:
+            os.unlink(tmp_path)
+            raise
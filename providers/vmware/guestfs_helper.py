@@ -1,18 +1,33 @@
+import atexit
 import guestfs
 import logging
 import nbd
 import os
 import subprocess
 import tempfile
+import threading
 import time
 
 from pyVim.task import WaitForTask
 
-class GuestfsHelper:
-    def __init__(self, request, side, state):
-        self._request = request
-        self._side = side
-        self._state = state
+from providers.guestfs_helper import cgroup_cmd
+from providers.vmware.nbd_connections import NbdConnectionManager
+
+class HostCredentials:
+    """
+    TLS thumbprints and password files of the hosts nbdkit connects to,
+    shared by every nbdkit launched by the runner. Each host and user gets
+    a single password file, removed on exit. Thumbprints are retrieved again
+    after THUMBPRINT_TTL, in case the host certificate has changed.
+    """
+
+    THUMBPRINT_TTL = 3600 # 1 hour
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thumbprints = {}
+        self._password_files = {}
+        atexit.register(self.cleanup)
 
 
     def _create_password_file(self, password, pwddir="/tmp"):
@@ -40,6 +55,55 @@ class GuestfsHelper:
         else:
             tp = hashlib.sha1(wrapped_socket.getpeercert(True)).hexdigest().upper()
             return ":".join([tp[i:i+2] for i in range(0, len(tp), 2)])
+        finally:
+            wrapped_socket.close()
+
+
+    def thumbprint(self, host, port=443):
+        with self._lock:
+            thumbprint = self._thumbprints.get((host, port))
+            if thumbprint is None or time.monotonic() >= thumbprint["expires"]:
+                logging.debug("Retrieving thumbprint of %s:%s", host, port)
+                thumbprint = {
+                    "value": self._get_thumbprint(host, port),
+                    "expires": time.monotonic() + self.THUMBPRINT_TTL
+                }
+                self._thumbprints[(host, port)] = thumbprint
+            return thumbprint["value"]
+
+
+    def password_file(self, host, username, password, pwddir="/tmp"):
+        with self._lock:
+            password_file = self._password_files.get((host, username))
+            if password_file is not None and password_file["password"] != password:
+                os.remove(password_file["path"])
+                password_file = None
+            if password_file is None or not os.path.exists(password_file["path"]):
+                password_file = {
+                    "password": password,
+                    "path": self._create_password_file(password, pwddir)
+                }
+                self._password_files[(host, username)] = password_file
+            return password_file["path"]
+
+
+    def cleanup(self):
+        with self._lock:
+            for password_file in self._password_files.values():
+                if os.path.exists(password_file["path"]):
+                    os.remove(password_file["path"])
+            self._password_files = {}
+
+
+host_credentials = HostCredentials()
+
+
+class GuestfsHelper:
+    def __init__(self, request, side, state):
+        self._request = request
+        self._side = side
+        self._state = state
+        self._nbd_connections = NbdConnectionManager("/tmp/%s/nbd" % self._request["vm_name"])
 
 
     def _get_nbdkit_cmd_ssh(self, disk_spec, socket_path, **kwargs):
@@ -65,7 +129,7 @@ class GuestfsHelper:
             "verify-remote-host=false",
             "host=%s" % kwargs["hostname"],
             "user=%s" % kwargs["username"],
-            "password=+%s" % self._create_password_file(kwargs["password"], pwddir="/tmp/%s" % self._request["vm_name"]),
+            "password=+%s" % host_credentials.password_file(kwargs["hostname"], kwargs["username"], kwargs["password"], pwddir="/tmp/%s" % self._request["vm_name"]),
             "path=%s" % disk_spec["absolute_path"],
             "logfile=/tmp/%s/nbd/%s-%s" % (self._request["vm_name"], disk_spec["id"], kwargs["sync_index"])
         ])
@@ -99,20 +163,20 @@ class GuestfsHelper:
             "vddk",
             "libdir=%s" % kwargs["vddk_path"],
             "server=%s" % kwargs["hostname"],
-            "thumbprint=%s" % self._get_thumbprint(kwargs["hostname"]),
+            "thumbprint=%s" % host_credentials.thumbprint(kwargs["hostname"]),
             "user=%s" % kwargs["username"],
-            "password=+%s" % self._create_password_file(kwargs["password"], pwddir="/tmp/%s" % self._request["vm_name"]),
+            "password=+%s" % host_credentials.password_file(kwargs["hostname"], kwargs["username"], kwargs["password"], pwddir="/tmp/%s" % self._request["vm_name"]),
             "file=%s" % disk_spec["path"],
             "vm=moref=%s" % kwargs["vm_moref"]
         ])
 
-        if "snapshot_moref" in kwargs:
+        if kwargs.get("snapshot_moref") is not None:
             nbdkit_cmd.extend(["snapshot=moref=%s" % kwargs["snapshot_moref"]])
 
         return nbdkit_cmd
 
 
-    # TODO: Add support for rate filter
+    # Network limits are enforced by the transfer loop, not by nbdkit
     def nbd_expose_disk_cmd(self, disk_spec, socket_path, **kwargs):
         if "vm_moref" not in kwargs:
             raise Exception("Neither 'vm_moref', nor 'snapshot_moref' key was supplied. Can't create NBD server.")
@@ -141,7 +205,54 @@ class GuestfsHelper:
             ) if "vddk_path" in kwargs else "/opt/vmware-vix-disklib-distrib"
         )
 
-        return nbdkit_cmd
+        return cgroup_cmd(nbdkit_cmd, self._state.cgroup)
+
+
+    def _nbd_target(self, **kwargs):
+        # The ssh plugin reads the disk file directly, so its server never
+        # needs to be restarted. VDDK servers are bound to a snapshot.
+        if self._request["source"]["transport_method"] == "vddk":
+            return kwargs.get("snapshot_moref")
+        return None
+
+
+    def nbd_expose_disk(self, disk_spec, **kwargs):
+        return self._nbd_connections.expose(
+            disk_spec["id"],
+            self._nbd_target(**kwargs),
+            lambda socket_path: self.nbd_expose_disk_cmd(disk_spec, socket_path, **kwargs)
+        )
+
+
+    def nbd_connect(self, disk_spec, connections=1, **kwargs):
+        # The vddk plugin serializes all requests within a server, so each
+        # connection gets its own server. The ssh plugin serves concurrent
+        # connections from a single server.
+        if self._request["source"]["transport_method"] == "vddk":
+            servers = connections
+        else:
+            servers = 1
+
+        return self._nbd_connections.connect(
+            disk_spec["id"],
+            self._nbd_target(**kwargs),
+            lambda socket_path: self.nbd_expose_disk_cmd(disk_spec, socket_path, **kwargs),
+            connections=connections,
+            servers=servers
+        )
+
+
+    def nbd_disconnect(self, disk_spec):
+        self._nbd_connections.disconnect(disk_spec["id"])
+
+
+    def nbd_release_snapshot(self, snapshot_moref):
+        # VDDK must not hold the snapshot disks open while it is removed
+        self._nbd_connections.disconnect_target(snapshot_moref)
+
+
+    def nbd_close_connections(self):
+        self._nbd_connections.close()
 
 
     def nbd_process_aio_requests(self, nbd_handle):
@@ -168,25 +279,15 @@ class GuestfsHelper:
 
 
     def _get_vm_operating_system_disk(self, vm_hardware, snapshot_moref=None, extended=False):
+        # The NBD servers are left running afterwards, so that the first sync
+        # can reuse them if it reads from the same snapshot.
         sockets_paths = []
-        nbd_servers = []
         for disk in vm_hardware["disks"]:
-            socket_path = "/tmp/%s/%s.sock" % (self._request["vm_name"], self._request["vm_uuid"])
-            nbdkit_cmd = self.nbd_expose_disk_cmd(disk, socket_path, vm_moref=vm_hardware["metadata"]["vm_moref"], snapshot_moref=snapshot_moref, sync_index=-1)
-            logging.debug("NBDKIT COMMAND: %s", nbdkit_cmd)
-            nbd_server = subprocess.Popen(nbdkit_cmd)
-
-            # Allowing some time for the socket to be created
-            for i in range(10):
-                if os.path.exists(socket_path):
-                    break
-                time.sleep(1)
-
+            socket_path = self.nbd_expose_disk(disk, vm_moref=vm_hardware["metadata"]["vm_moref"], snapshot_moref=snapshot_moref, sync_index=-1)
             sockets_paths.append(socket_path)
-            nbd_servers.append(nbd_server)
 
+        g = guestfs.GuestFS(python_return_dict=True)
         try:
-            g = guestfs.GuestFS(python_return_dict=True)
             g.set_backend("direct")
             for socket_path in sockets_paths:
                 g.add_drive_opts("", protocol="nbd", format="raw", server=["unix:%s" % socket_path], readonly=1)
@@ -225,9 +326,6 @@ class GuestfsHelper:
         except Exception as error:
             raise error
         finally:
-            for nbd_server in nbd_servers:
-                nbd_server.kill()
-            for socket_path in sockets_paths:
-                os.remove(socket_path)
+            g.close()
 
         return operating_systems[0]
@@ -0,0 +1,79 @@
+import threading
+import time
+
+
+class MorefCache:
+    """
+    Managed object references, and properties that don't change, looked up
+    in vCenter, indexed by kind and key (UUID or moref). Entries expire after
+    `ttl` seconds and are invalidated when vCenter reports their managed
+    object as gone. Hits and misses are counted per kind.
+    """
+
+    def __init__(self, ttl):
+        self._ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._stats = {}
+
+
+    def _count(self, kind, hit):
+        stats = self._stats.setdefault(kind, {"hits": 0, "misses": 0})
+        stats["hits" if hit else "misses"] += 1
+
+
+    def get(self, kind, key, lookup=None):
+        """
+        Return the cached value, or the one returned by `lookup` on a miss.
+        Without `lookup`, a miss returns None.
+        """
+        with self._lock:
+            entry = self._entries.get((kind, key))
+            hit = entry is not None and time.monotonic() < entry["expires"]
+            self._count(kind, hit)
+        if hit:
+            return entry["value"]
+        if lookup is None:
+            return None
+
+        value = lookup()
+        self.put(kind, key, value)
+        return value
+
+
+    def put(self, kind, key, value):
+        with self._lock:
+            self._entries[(kind, key)] = {
+                "value": value,
+                "expires": time.monotonic() + self._ttl
+            }
+
+
+    def invalidate(self, kind=None, key=None):
+        with self._lock:
+            for entry_kind, entry_key in list(self._entries):
+                if kind in (None, entry_kind) and key in (None, entry_key):
+                    del self._entries[(entry_kind, entry_key)]
+
+
+    def invalidate_object(self, moref):
+        """
+        Invalidate the entries that are or hold the managed object `moref`
+        """
+        with self._lock:
+            for entry_key, entry in list(self._entries.items()):
+                if entry_key[1] == moref._moId or self._holds(entry["value"], moref._moId):
+                    del self._entries[entry_key]
+
+
+    def _holds(self, value, moref_id):
+        if isinstance(value, list):
+            return any(self._holds(v, moref_id) for v in value)
+        if isinstance(value, dict):
+            return value.get("moref") == moref_id
+        return getattr(value, "_moId", None) == moref_id
+
+
+    def stats(self):
+        with self._lock:
+            return {kind: dict(stats) for kind, stats in self._stats.items()}
@@ -0,0 +1,139 @@
+import logging
+import nbd
+import os
+import subprocess
+import threading
+import time
+
+
+class NbdConnectionManager:
+    """
+    Keeps the nbdkit servers of each source disk, listening on Unix sockets,
+    and the NBD handles connected to them, for as long as the served target
+    doesn't change. This avoids paying the nbdkit start, VDDK session and TLS
+    setup for every sync.
+
+    A disk can have several servers and several handles. Handle i is
+    connected to server i modulo the number of servers.
+    """
+
+    SOCKET_TIMEOUT = 10 # 10 seconds
+
+    def __init__(self, socket_dir):
+        self._socket_dir = socket_dir
+        self._disks = {}
+        self._lock = threading.Lock()
+
+
+    def _start_server(self, disk_id, index, nbdkit_cmd_factory):
+        socket_path = "%s/%s.%d.sock" % (self._socket_dir, disk_id, index)
+        if os.path.exists(socket_path):
+            os.remove(socket_path)
+
+        nbdkit_cmd = nbdkit_cmd_factory(socket_path)
+        logging.debug("Starting NBD server %d for disk %s: %s", index, disk_id, nbdkit_cmd)
+        process = subprocess.Popen(nbdkit_cmd)
+
+        # Allowing some time for the socket to be created
+        for i in range(self.SOCKET_TIMEOUT):
+            if os.path.exists(socket_path):
+                break
+            if process.poll() is not None:
+                raise Exception("NBD server for disk %s exited with code %d" % (disk_id, process.returncode))
+            time.sleep(1)
+        else:
+            process.kill()
+            raise Exception("NBD server for disk %s didn't create socket %s" % (disk_id, socket_path))
+
+        return {
+            "process": process,
+            "socket_path": socket_path
+        }
+
+
+    def _stop_disk(self, disk):
+        for nbd_handle in disk["handles"]:
+            try:
+                nbd_handle.shutdown()
+            except:
+                pass
+        for server in disk["servers"]:
+            server["process"].kill()
+            server["process"].wait()
+            if os.path.exists(server["socket_path"]):
+                os.remove(server["socket_path"])
+
+
+    def _get_disk(self, disk_id, target):
+        with self._lock:
+            disk = self._disks.get(disk_id)
+
+        if disk is not None:
+            if disk["target"] != target or any(s["process"].poll() is not None for s in disk["servers"]):
+                logging.info("Restarting NBD servers for disk %s (target %s -> %s)", disk_id, disk["target"], target)
+                self._stop_disk(disk)
+                disk = None
+
+        if disk is None:
+            disk = {
+                "target": target,
+                "servers": [],
+                "handles": []
+            }
+            with self._lock:
+                self._disks[disk_id] = disk
+
+        return disk
+
+
+    def expose(self, disk_id, target, nbdkit_cmd_factory):
+        """
+        Return the socket of the first NBD server for the disk, (re)starting
+        the server if it isn't running or serves another target.
+        """
+        disk = self._get_disk(disk_id, target)
+        if len(disk["servers"]) == 0:
+            disk["servers"].append(self._start_server(disk_id, 0, nbdkit_cmd_factory))
+        return disk["servers"][0]["socket_path"]
+
+
+    def connect(self, disk_id, target, nbdkit_cmd_factory, connections=1, servers=1):
+        """
+        Return a list of `connections` NBD handles to the disk, spread over
+        `servers` NBD servers. Existing servers and handles are reused.
+        """
+        disk = self._get_disk(disk_id, target)
+        while len(disk["servers"]) < servers:
+            disk["servers"].append(self._start_server(disk_id, len(disk["servers"]), nbdkit_cmd_factory))
+
+        while len(disk["handles"]) < connections:
+            server = disk["servers"][len(disk["handles"]) % len(disk["servers"])]
+            logging.info("Opening NBD connection %d to disk %s", len(disk["handles"]), disk_id)
+            nbd_handle = nbd.NBD()
+            nbd_handle.add_meta_context("base:allocation")
+            nbd_handle.connect_unix(server["socket_path"])
+            disk["handles"].append(nbd_handle)
+
+        return disk["handles"][:connections]
+
+
+    def disconnect(self, disk_id):
+        with self._lock:
+            disk = self._disks.pop(disk_id, None)
+        if disk is not None:
+            self._stop_disk(disk)
+
+
+    def disconnect_target(self, target):
+        with self._lock:
+            disk_ids = [k for k, v in self._disks.items() if v["target"] == target]
+        for disk_id in disk_ids:
+            self.disconnect(disk_id)
+
+
+    def close(self):
+        with self._lock:
+            disks = list(self._disks.values())
+            self._disks = {}
+        for disk in disks:
+            self._stop_disk(disk)
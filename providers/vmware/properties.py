@@ -0,0 +1,46 @@
+from pyVmomi import vim, vmodl
+
+
+def object_specs(objects):
+    return [vmodl.query.PropertyCollector.ObjectSpec(obj=obj, skip=False) for obj in objects]
+
+
+def view_object_spec(view):
+    """
+    Object spec selecting the objects of a container view
+    """
+    traversal_spec = vmodl.query.PropertyCollector.TraversalSpec(
+        name="traverseView",
+        path="view",
+        skip=False,
+        type=vim.view.ContainerView
+    )
+    return vmodl.query.PropertyCollector.ObjectSpec(obj=view, skip=True, selectSet=[traversal_spec])
+
+
+def retrieve_properties(connection, obj_specs, paths):
+    """
+    Retrieve properties of many managed objects at once, instead of one SOAP
+    round trip per attribute access. `paths` maps managed object types to
+    the property paths to retrieve. Returns a dict of properties indexed by
+    managed object id, only holding the properties that are set.
+    """
+    property_collector = connection.content.propertyCollector
+    filter_spec = vmodl.query.PropertyCollector.FilterSpec(
+        objectSet=obj_specs,
+        propSet=[
+            vmodl.query.PropertyCollector.PropertySpec(type=obj_type, pathSet=path_set, all=False)
+            for obj_type, path_set in paths.items()
+        ]
+    )
+
+    properties = {}
+    result = property_collector.RetrievePropertiesEx([filter_spec], vmodl.query.PropertyCollector.RetrieveOptions())
+    while result is not None:
+        for obj in result.objects:
+            properties[obj.obj._moId] = {prop.name: prop.val for prop in obj.propSet}
+        if result.token is None:
+            break
+        result = property_collector.ContinueRetrievePropertiesEx(result.token)
+
+    return properties
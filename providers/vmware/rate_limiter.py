@@ -0,0 +1,35 @@
+import threading
+import time
+
+
+class RateLimiter:
+    """
+    Token bucket shared by all the transfer threads. The rate, in bytes per
+    second, is read on every call so that it can change while copying. No
+    rate means no limit.
+    """
+
+    def __init__(self, get_rate):
+        self._get_rate = get_rate
+        self._lock = threading.Lock()
+        self._tokens = 0
+        self._last = time.monotonic()
+
+
+    def consume(self, length):
+        while True:
+            rate = self._get_rate()
+            if rate is None:
+                return
+
+            with self._lock:
+                now = time.monotonic()
+                # Allow bursts of up to one second worth of data
+                self._tokens = min(rate, self._tokens + (now - self._last) * rate)
+                self._last = now
+                if self._tokens >= min(length, rate):
+                    self._tokens -= length
+                    return
+                delay = (min(length, rate) - self._tokens) / rate
+
+            time.sleep(delay)
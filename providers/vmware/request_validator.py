@@ -20,9 +20,23 @@ class RequestSourceValidator(object):
 
         getattr(self, '_validate_authentication_' + self._request["source"]["transport_method"])
 
+        for key in ["nbd_connections", "max_sync_workers", "flush_interval", "max_snapshots", "buffer_budget"]:
+            self._validate_integer(key, 1)
+        self._validate_integer("extent_gap", 0)
+
         return self._errors
 
 
+    def _validate_integer(self, key, minimum):
+        # bool is a subclass of int, but true and false aren't sizes or counts
+        if key not in self._request["source"]:
+            return
+        value = self._request["source"][key]
+        if not isinstance(value, int) or isinstance(value, bool) or value < minimum:
+            qualifier = "positive" if minimum > 0 else "non-negative"
+            self._errors.append("'%s' in request['source'] must be a %s integer" % (key, qualifier))
+
+
     def _validate_authentication_vddk(self):
         if "username" not in self._request["source"]["authentication"]:
             self._errors.append("Missing 'username' in request['source']['authentication']")
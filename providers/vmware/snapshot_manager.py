@@ -0,0 +1,96 @@
+import concurrent.futures
+import contextvars
+import logging
+import threading
+import time
+
+from pyVmomi import vim
+from pyVim.task import WaitForTask
+
+
+class SnapshotManager:
+    """
+    Snapshots taken for the syncs of a VM. A snapshot taken beforehand, like
+    the inspection one, can be handed over to the next sync. Snapshots are
+    removed in the background, one at a time, so that consolidation doesn't
+    hold up the next sync. At most `max_snapshots` of them exist at once.
+    """
+
+    def __init__(self, vm_manager, max_snapshots):
+        self._vm_manager = vm_manager
+        self._max_snapshots = max_snapshots
+        self._lock = threading.Lock()
+        self._adopted = None
+        self._removals = []
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+
+    def adopt(self, snapshot):
+        with self._lock:
+            self._adopted = snapshot
+
+
+    def take(self, vm_id, name):
+        with self._lock:
+            snapshot = self._adopted
+            self._adopted = None
+        if snapshot is not None:
+            logging.info("Reusing snapshot %s for VM: %s", snapshot._moId, vm_id)
+            return snapshot
+
+        # The snapshot about to be taken counts as well
+        self.wait(self._max_snapshots - 1)
+        while True:
+            try:
+                return self._vm_manager.create_snapshot(vm_id, name)
+            except vim.fault.TaskInProgress:
+                # vSphere runs one snapshot task at a time per VM, so a
+                # removal still running holds up the creation
+                with self._lock:
+                    outstanding = len(self._removals)
+                if outstanding == 0:
+                    raise
+                logging.info("Waiting for a snapshot removal to finish before taking snapshot %s", name)
+                self.wait(outstanding - 1)
+
+
+    def release(self, snapshot):
+        logging.info("Removing snapshot %s in the background", snapshot._moId)
+        with self._lock:
+            self._removals.append(self._executor.submit(contextvars.copy_context().run, self._remove, snapshot))
+
+
+    def release_all(self):
+        """
+        Remove the adopted snapshot if no sync took it, and wait until all
+        the removals are done.
+        """
+        with self._lock:
+            snapshot = self._adopted
+            self._adopted = None
+        if snapshot is not None:
+            self.release(snapshot)
+        self.wait()
+
+
+    def _remove(self, snapshot):
+        started = time.monotonic()
+        WaitForTask(snapshot.RemoveSnapshot_Task(True))
+        logging.info("Snapshot %s removed in %.1fs", snapshot._moId, time.monotonic() - started)
+
+
+    def wait(self, outstanding=0):
+        """
+        Wait until at most `outstanding` removals are left. A failed removal
+        is raised here, by the first call that sees it.
+        """
+        with self._lock:
+            removals = list(self._removals)
+        # Removals run in order, so the oldest ones finish first
+        concurrent.futures.wait(removals[:max(0, len(removals) - outstanding)])
+
+        with self._lock:
+            finished = [f for f in self._removals if f.done()]
+            self._removals = [f for f in self._removals if not f.done()]
+        for future in finished:
+            future.result()
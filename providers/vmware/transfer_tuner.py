@@ -0,0 +1,93 @@
+import logging
+import time
+
+
+class TransferTuner:
+    """
+    Adjusts the NBD queue depth and read request size while a disk is being
+    copied. Each setting is doubled for as long as the measured throughput
+    improves, then the best values seen are kept.
+    """
+
+    WINDOW_DURATION = 2 # seconds
+    MIN_GAIN = 1.05
+
+    def __init__(self, pread_len, max_pread_len, aio_in_flight, max_aio_in_flight, enabled=True):
+        self.pread_len = min(pread_len, max_pread_len)
+        self.aio_in_flight = min(aio_in_flight, max_aio_in_flight)
+        self._max_pread_len = max_pread_len
+        self._max_aio_in_flight = max_aio_in_flight
+        self._phase = "aio_in_flight" if enabled else "stable"
+        self._best = None
+
+        self.throughput = 0
+        self.latency = 0
+        self._start = time.monotonic()
+        self._bytes = 0
+        self._window_start = self._start
+        self._window_bytes = 0
+        self._window_latency = 0
+        self._window_requests = 0
+
+
+    def record(self, length, latency):
+        self._bytes += length
+        self._window_bytes += length
+        self._window_latency += latency
+        self._window_requests += 1
+
+        now = time.monotonic()
+        if now - self._window_start >= self.WINDOW_DURATION:
+            self._end_window(now)
+
+
+    def _end_window(self, now):
+        throughput = self._window_bytes / (now - self._window_start)
+        self.throughput = throughput
+        self.latency = self._window_latency / self._window_requests
+        logging.debug("Transfer window: %d B/s, %.3f s latency with aio_in_flight=%d and pread_len=%d",
+            throughput, self.latency, self.aio_in_flight, self.pread_len)
+
+        self._window_start = now
+        self._window_bytes = 0
+        self._window_latency = 0
+        self._window_requests = 0
+
+        if self._phase == "stable":
+            return
+
+        if self._best is None or throughput > self._best[0] * self.MIN_GAIN:
+            self._best = (throughput, self.aio_in_flight, self.pread_len)
+        else:
+            # The last step didn't pay off: go back to the best values and
+            # move on to the next setting.
+            self.aio_in_flight = self._best[1]
+            self.pread_len = self._best[2]
+            self._phase = "pread_len" if self._phase == "aio_in_flight" else "stable"
+        self._step()
+
+
+    def _step(self):
+        if self._phase == "aio_in_flight":
+            if self.aio_in_flight < self._max_aio_in_flight:
+                self.aio_in_flight = min(self.aio_in_flight * 2, self._max_aio_in_flight)
+                return
+            self._phase = "pread_len"
+
+        if self._phase == "pread_len":
+            if self.pread_len < self._max_pread_len:
+                self.pread_len = min(self.pread_len * 2, self._max_pread_len)
+                return
+            self._phase = "stable"
+
+        logging.info("Transfer settings tuned to aio_in_flight=%d and pread_len=%d", self.aio_in_flight, self.pread_len)
+
+
+    def summary(self):
+        duration = time.monotonic() - self._start
+        return {
+            "aio_in_flight": self.aio_in_flight,
+            "pread_len": self.pread_len,
+            "throughput": int(self.throughput or (self._bytes / duration if duration > 0 else 0)),
+            "latency": round(self.latency, 3)
+        }
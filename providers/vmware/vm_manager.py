@@ -1,23 +1,101 @@
+import concurrent.futures
+import contextvars
 from datetime import datetime
+import functools
+import hashlib
 import logging
 import nbd
 import os
+import queue
+import random
 import ssl
+import threading
+import time
 
-from pyVmomi import vim
+from pyVmomi import vim, vmodl
 from pyVim.connect import SmartStubAdapter, VimSessionOrientedStub, Disconnect
 from pyVim.task import WaitForTask
 
+from providers.sessions import session_pool
+from providers.vmware.disk_io import BufferPool, Zeroer, buffers_equal
+from providers.vmware.moref_cache import MorefCache
+from providers.vmware.extents import AllocationMap, Extent, add_range, clip_extents, coalesce_extents, merge_blocks, split_blocks, subtract_ranges
+from providers.vmware.properties import object_specs, retrieve_properties, view_object_spec
+from providers.vmware.rate_limiter import RateLimiter
+from providers.vmware.snapshot_manager import SnapshotManager
+from providers.vmware.transfer_tuner import TransferTuner
+
+class SyncInterrupted(Exception):
+    pass
+
+
+def invalidates_morefs(method):
+    """
+    Drop cached managed objects that vCenter reports as gone, so that the
+    next call looks them up again. Any other error may come from a stale
+    reference too, so the whole cache is dropped.
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        try:
+            return method(self, *args, **kwargs)
+        except vmodl.fault.ManagedObjectNotFound as err:
+            logging.debug("Managed object %s not found, invalidating cached references", err.obj)
+            self._morefs.invalidate_object(err.obj)
+            raise
+        except Exception:
+            # Errors of sync workers are wrapped in a generic exception, which
+            # doesn't tell which managed object, if any, is gone
+            logging.debug("%s failed, invalidating all cached references", method.__name__)
+            self._morefs.invalidate()
+            raise
+    return wrapper
+
+
 class VmManager:
+
+    MAX_SYNC_WORKERS = 4
+    EXTENT_GAP = 256 << 10 # 256KB
+    MIN_STRIPE_LEN = 1 << 30 # 1GB
+    VERIFY_CHUNK_LEN = 4 << 20 # 4MB
+    VERIFY_SAMPLE_RATIO = 0.01
+    VERIFY_CONNECTIONS = 4
+    MAX_SNAPSHOTS = 2
+    MOREF_CACHE_TTL = 300 # 5 minutes
+    FLUSH_INTERVAL = 1 << 30 # 1GB
+    DIRECT_IO_ALIGNMENT = 4096
+    BUFFER_BUDGET = 1 << 30 # 1GB of read buffers per migration
+    TRANSFER_LIMITS = {
+        "vddk": {
+            "pread_len": 23 << 20,
+            "max_pread_len": 23 << 20, # 23MB (24MB requests fail in VDDK)
+            "aio_in_flight": 2,
+            "max_aio_in_flight": 16,
+            "connections": 2 # One nbdkit, and VDDK session, per connection
+        },
+        "ssh": {
+            "pread_len": 4 << 20,
+            "max_pread_len": 32 << 20, # 32MB (NBD maximum request size)
+            "aio_in_flight": 2,
+            "max_aio_in_flight": 8,
+            "connections": 4
+        }
+    }
+
     def __init__(self, request, side, state):
         self._request = request
         self._side = side
         self._state = state
-        self._connection = self._connect()
-
-
-    def __del__(self):
-        self._disconnect()
+        session_key = (
+            "vmware",
+            self._request[self._side]["authentication"]["host"]["hostname"],
+            self._request[self._side]["authentication"]["host"]["username"]
+        )
+        self._connection = session_pool.acquire(session_key, self._connect, Disconnect)
+        self._session_key = session_key
+        self._morefs = MorefCache(self._request[self._side].get("moref_cache_ttl", self.MOREF_CACHE_TTL))
+        self._rate_limiter = RateLimiter(lambda: self._state.throttling["network"])
+        self._snapshots = SnapshotManager(self, self._request[self._side].get("max_snapshots", self.MAX_SNAPSHOTS))
 
 
     def _connect(self):
@@ -44,14 +122,26 @@ class VmManager:
         return conn
 
 
-    def _disconnect(self):
-        try:
-            Disconnect(self._connection)
-        except:
-            pass
+    def close(self):
+        """
+        Hand the session back to the pool. Closing twice is harmless.
+        """
+        if self._session_key is None:
+            return
+        session_pool.release(self._session_key)
+        self._session_key = None
+        logging.info("Managed object cache: %s", self.moref_cache_stats())
+
+
+    def moref_cache_stats(self):
+        return self._morefs.stats()
 
 
     def _find_vm_by_id(self, vm_id):
+        return self._morefs.get("vm", vm_id, lambda: self._lookup_vm_by_id(vm_id))
+
+
+    def _lookup_vm_by_id(self, vm_id):
         logging.debug("Looking for virtual machine with UUID '%s'" % vm_id)
         vm = self._connection.content.searchIndex.FindByUuid(None, vm_id, True)
         if vm is None:
@@ -60,59 +150,132 @@ class VmManager:
 
 
     def _get_hosts(self):
+        return self._morefs.get("hosts", None, self._lookup_hosts)
+
+
+    def _lookup_hosts(self):
         host_view = self._connection.content.viewManager.CreateContainerView(self._connection.content.rootFolder, [vim.HostSystem], True)
         hosts = [host for host in host_view.view]
         host_view.Destroy()
         return hosts
 
 
-    def _get_device_controller(self, device, device_list):
+    def _get_device_controller(self, device, devices, controllers):
+        """
+        Resolve the controller chain of a device from `devices`, indexed by
+        key. Controllers already resolved are memoised in `controllers`.
+        """
         if device.controllerKey is None:
             return None
+        if device.controllerKey in controllers:
+            return controllers[device.controllerKey]
 
-        ctlr = next(dev for dev in device_list if dev.key == device.controllerKey)
+        ctlr = devices[device.controllerKey]
         controller = {
             "type": type(ctlr).__name__.split(".")[-1],
             "key": ctlr.key,
             "name": ctlr.deviceInfo.label,
             "bus_number": ctlr.busNumber,
-            "controller": self._get_device_controller(ctlr, device_list)
+            "controller": self._get_device_controller(ctlr, devices, controllers)
         }
 
         if ctlr.slotInfo is not None:
             controller["pci_slot_number"] = ctlr.slotInfo.pciSlotNumber
 
+        controllers[device.controllerKey] = controller
         return controller
 
 
+    def _find_dvs_by_uuid(self, dvs_uuid):
+        dvs = self._morefs.get("dvs", dvs_uuid)
+        if dvs is not None:
+            return dvs
+
+        # A single retrieval caches all the switches
+        dvs_view = self._connection.content.viewManager.CreateContainerView(self._connection.content.rootFolder, [vim.DistributedVirtualSwitch], True)
+        try:
+            dvs_properties = retrieve_properties(
+                self._connection,
+                [view_object_spec(dvs_view)],
+                {vim.DistributedVirtualSwitch: ["uuid", "name"]}
+            )
+        finally:
+            dvs_view.Destroy()
+        for dvs_id, properties in dvs_properties.items():
+            self._morefs.put("dvs", properties["uuid"], {"moref": dvs_id, "name": properties["name"]})
+            if properties["uuid"] == dvs_uuid:
+                dvs = {"moref": dvs_id, "name": properties["name"]}
+
+        if dvs is None:
+            raise Exception("DVS with UUID '%s' not found" % dvs_uuid)
+        return dvs
+
+
+    @invalidates_morefs
     def get_vm_hardware(self, vm_id):
         vm = self._find_vm_by_id(vm_id)
-        host = vm.runtime.host
-        content = self._connection.RetrieveContent()
+
+        # Everything is retrieved upfront in a few calls, then read locally
+        vm_properties = retrieve_properties(
+            self._connection,
+            object_specs([vm]),
+            {vim.VirtualMachine: ["config.changeTrackingEnabled", "config.hardware", "runtime.host", "snapshot"]}
+        )[vm._moId]
+        host = vm_properties["runtime.host"]
+        vm_hardware = vm_properties["config.hardware"]
+        device_list = vm_hardware.device
+        devices = {device.key: device for device in device_list}
+        controllers = {}
+
+        datastores = {
+            device.backing.datastore._moId: device.backing.datastore
+            for device in device_list
+            if type(device).__name__ == 'vim.vm.device.VirtualDisk'
+        }
+        # Datastore names and URLs don't change, cached ones are reused
+        datastore_properties = {ds_id: self._morefs.get("datastore", ds_id) for ds_id in datastores}
+        missing_datastores = [datastores[ds_id] for ds_id, p in datastore_properties.items() if p is None]
+
+        networks = {
+            device.backing.network._moId: device.backing.network
+            for device in device_list
+            if type(device.backing).__name__ == 'vim.vm.device.VirtualEthernetCard.NetworkBackingInfo' and device.backing.network is not None
+        }
+        properties = retrieve_properties(
+            self._connection,
+            object_specs(missing_datastores + list(networks.values()) + [host]),
+            {
+                vim.Datastore: ["name", "summary.url"],
+                vim.Network: ["name"],
+                vim.HostSystem: ["config.network.portgroup"]
+            }
+        )
+        for datastore in missing_datastores:
+            datastore_properties[datastore._moId] = properties[datastore._moId]
+            self._morefs.put("datastore", datastore._moId, properties[datastore._moId])
 
         hardware = {
             "metadata": {
                 "vm_moref": vm._moId,
-                "has_snapshots": vm.snapshot is not None,
-                "cbt_enabled": vm.config.changeTrackingEnabled
+                "has_snapshots": vm_properties.get("snapshot") is not None,
+                "cbt_enabled": vm_properties.get("config.changeTrackingEnabled")
             },
             "cpu": {
-                "sockets": vm.config.hardware.numCPU / vm.config.hardware.numCoresPerSocket,
-                "cores_per_socket": vm.config.hardware.numCoresPerSocket
+                "sockets": vm_hardware.numCPU / vm_hardware.numCoresPerSocket,
+                "cores_per_socket": vm_hardware.numCoresPerSocket
             },
-            "memory": vm.config.hardware.memoryMB * 2**20,
+            "memory": vm_hardware.memoryMB * 2**20,
             "disks": [],
             "nics": [],
             "video_cards": []
         }
 
-        device_list = vm.config.hardware.device
         for device in device_list:
             if type(device).__name__ == 'vim.vm.device.VirtualDisk':
-                datastore = device.backing.datastore
-                datastore_mountpoint = datastore.summary.url.replace("ds://", "")
-                datastore_uuid = datastore.summary.url.replace("ds://", "").split("/")[-1]
-                absolute_path = "%s/%s" % (datastore_mountpoint, device.backing.fileName.replace("[%s] " % datastore.name, ""))
+                datastore = datastore_properties[device.backing.datastore._moId]
+                datastore_mountpoint = datastore["summary.url"].replace("ds://", "")
+                datastore_uuid = datastore["summary.url"].replace("ds://", "").split("/")[-1]
+                absolute_path = "%s/%s" % (datastore_mountpoint, device.backing.fileName.replace("[%s] " % datastore["name"], ""))
                 disk = {
                     "id": device.backing.uuid,
                     "key": device.key,
@@ -120,13 +283,13 @@ class VmManager:
                     "size": device.capacityInBytes,
                     "path": device.backing.fileName,
                     "absolute_path": absolute_path,
-                    "datastore_name": datastore.name,
+                    "datastore_name": datastore["name"],
                     "datastore_mountpoint": datastore_mountpoint,
                     "datastore_uuid": datastore_uuid,
                     "is_sparse": device.backing.thinProvisioned,
                     "is_rdm": type(device.backing).__name__ == 'vim.vm.device.VirtualDisk.VirtualDiskRawDiskMappingVer1BackingInfo',
                     "unit_number": device.unitNumber,
-                    "controller": self._get_device_controller(device, device_list)
+                    "controller": self._get_device_controller(device, devices, controllers)
                 }
 
                 hardware["disks"].append(disk)
@@ -135,14 +298,10 @@ class VmManager:
             if type(device.backing).__name__ == 'vim.vm.device.VirtualEthernetCard.NetworkBackingInfo':
                 if hasattr(device.backing, 'port'):
                     dvsUuid = device.backing.port.switchUuid
-                    try:
-                        dvs = content.dvSwitchManager.QueryDvsByUuid(dvsUuid)
-                        network_name = str(dvs.name)
-                    except:
-                        raise Exception("DVS with UUID '%s' not found" % dvsUuid)
+                    network_name = str(self._find_dvs_by_uuid(dvsUuid)["name"])
                 else:
-                    vm_portgroup = device.backing.network.name
-                    host_portgroups = host.config.network.portgroup
+                    vm_portgroup = properties[device.backing.network._moId]["name"]
+                    host_portgroups = properties[host._moId].get("config.network.portgroup", [])
                     for host_portgroup in host_portgroups:
                         if vm_portgroup in host_portgroup.key:
                             network_name = str(host_portgroup.spec.name)
@@ -156,7 +315,7 @@ class VmManager:
                         "name": device.backing.deviceName
                     },
                     "pci_slot_number": device.slotInfo.pciSlotNumber,
-                    "controller": self._get_device_controller(device, device_list)
+                    "controller": self._get_device_controller(device, devices, controllers)
                 }
 
                 hardware["nics"].append(nic)
@@ -169,7 +328,7 @@ class VmManager:
                     "graphics_memory": device.graphicsMemorySizeInKB * 104,
                     "number_of_displays": device.numDisplays,
                     "3d_enabled": device.enable3DSupport,
-                    "controller": self._get_device_controller(device, device_list)
+                    "controller": self._get_device_controller(device, devices, controllers)
                 }
 
                 hardware["video_cards"].append(video_card)
@@ -193,6 +352,7 @@ class VmManager:
         pass
 
 
+    @invalidates_morefs
     def enable_change_block_tracking(self, vm_id):
         logging.info("Enable change block tracking for VM: %s" % vm_id)
         vm = self._find_vm_by_id(vm_id)
@@ -200,6 +360,7 @@ class VmManager:
         WaitForTask(vm.Reconfigure(config_spec))
 
 
+    @invalidates_morefs
     def create_snapshot(self, vm_id, name, description=None, memory=False, quiesce=False):
         logging.info("Create snapshot for VM: %s", vm_id)
         vm = self._find_vm_by_id(vm_id)
@@ -226,6 +387,7 @@ class VmManager:
                 return self._find_snapshot_by_name(snapshot.childSnapshotList, name)
 
 
+    @invalidates_morefs
     def remove_snapshot(self, vm_id, snapshot_name):
         logging.info("Removing snapshot named '%s' for VM '%s'" % (snapshot_name, vm_id))
         vm = self._find_vm_by_id(vm_id)
@@ -234,6 +396,15 @@ class VmManager:
             WaitForTask(snapshot_tree.snapshot.RemoveSnapshot_Task(True))
 
 
+    def adopt_snapshot(self, snapshot):
+        self._snapshots.adopt(snapshot)
+
+
+    def release_snapshot(self):
+        self._snapshots.release_all()
+
+
+    @invalidates_morefs
     def remove_all_snapshots(self, vm_id):
         logging.info("Removing all snapshots for VM: %s" % vm_id)
         vm = self._find_vm_by_id(vm_id)
@@ -256,24 +427,73 @@ class VmManager:
                     dm["source"]["change_ids"].append(device.backing.changeId)
 
 
-    def _get_changed_extents(self, vm_id, snapshot, disks_mappings, sync_index, last_sync):
-        logging.info("Getting the list of changed extents since previous snapshot")
-        vm = self._find_vm_by_id(vm_id)
-        for dm in disks_mappings:
-            total_len = 0
-            extents = []
-
-            logging.debug("Change Ids for disk %s: %s", dm["source"]["id"], dm["source"]["change_ids"])
-            change_id = dm["source"]["change_ids"][-2]
-            
-            logging.debug("Retrieving changed extents for change_id: %s", change_id)
-            while total_len < dm["source"]["size"]:
-                tmp = vm.QueryChangedDiskAreas(snapshot, int(dm["source"]["key"]), total_len, change_id)
-                extents.extend(tmp.changedArea)
-                total_len = tmp.startOffset + tmp.length
-            total_size = sum(x.length for x in extents)
-            logging.debug("Gathered %d extents to transfer, with a total size of %d B" % (len(extents), total_size))
-            dm["source"]["extents"] = extents
+    def _query_changed_extents(self, vm, snapshot, dm, change_id):
+        """
+        Yield the changed extents of a disk one page at a time, along with
+        the [start, end[ range of the disk that the page covers.
+        """
+        logging.debug("Retrieving changed extents for change_id: %s", change_id)
+        start = 0
+        while start < dm["source"]["size"]:
+            tmp = vm.QueryChangedDiskAreas(snapshot, int(dm["source"]["key"]), start, change_id)
+            end = tmp.startOffset + tmp.length
+            yield start, end, [Extent(x.start, x.length) for x in tmp.changedArea]
+            start = end
+
+
+    def _get_changed_extents(self, vm, snapshot, dm, resumed):
+        logging.info("Getting the list of changed extents for disk: %s" % dm["source"]["id"])
+        logging.debug("Change Ids for disk %s: %s", dm["source"]["id"], dm["source"]["change_ids"])
+        pages = self._query_changed_extents(vm, snapshot, dm, dm["source"]["change_ids"][-2])
+        if resumed is None or len(resumed["completed"]) == 0:
+            for start, end, extents in pages:
+                yield extents
+            return
+
+        # Ranges completed by an unfinished sync only need to be copied
+        # again if they changed since that sync's snapshot. Those changes
+        # are queried alongside, for the same part of the disk.
+        logging.debug("Skipping %d ranges completed by the unfinished sync of change_id: %s", len(resumed["completed"]), resumed["change_id"])
+        resumed_pages = self._query_changed_extents(vm, snapshot, dm, resumed["change_id"])
+        resumed_end = 0
+        resumed_extents = []
+        for start, end, extents in pages:
+            while resumed_end < end:
+                resumed_start, resumed_end, page = next(resumed_pages)
+                resumed_extents += page
+            yield subtract_ranges(extents, resumed["completed"]) + clip_extents(resumed_extents, start, end)
+            resumed_extents = clip_extents(resumed_extents, end, dm["source"]["size"])
+
+
+    def _enumerate_changed_extents(self, vm, snapshot, dm, resumed, pages, stop_event):
+        try:
+            for extents in self._get_changed_extents(vm, snapshot, dm, resumed):
+                if stop_event.is_set():
+                    return
+                pages.put(extents)
+            pages.put(None)
+        except Exception as err:
+            pages.put(err)
+
+
+    def _next_extents_batch(self, pages):
+        """
+        Wait for the next page of changed extents, then take all the pages
+        that are already available. Returns the extents and whether the
+        enumeration is done.
+        """
+        extents = []
+        page = pages.get()
+        while True:
+            if isinstance(page, Exception):
+                raise page
+            if page is None:
+                return extents, True
+            extents += page
+            try:
+                page = pages.get_nowait()
+            except queue.Empty:
+                return extents, False
 
 
     def _get_block_status(self, nbd_handle, extent):
@@ -297,121 +517,635 @@ class VmManager:
                 })
                 offset += length
 
-        while last_offset < extent.start + extent.length:
+        end = extent.start + extent.length
+        while last_offset < end:
             nblocks = len(blocks)
-            length = min(extent.length, MAX_BLOCK_STATUS_LEN)
+            length = min(end - last_offset, MAX_BLOCK_STATUS_LEN)
             logging.debug("Calling block_status with length=%d offset=%d" % (length, last_offset))
             nbd_handle.block_status(length, last_offset, update_blocks)
             if len(blocks) == nblocks:
                 raise Exception("Missing block status data from NBD")
             last_offset = blocks[-1]['offset'] + blocks[-1]['length']
 
+        # The server may describe more than what was asked for
+        if last_offset > end:
+            blocks[-1]['length'] = end - blocks[-1]['offset']
+
         return blocks
 
 
-    def _write_data(self, fd, buf, offset, err):
-        logging.debug("Writing %d B to offset %d B", buf.size(), offset)
-        os.pwrite(fd, buf.to_bytearray(), offset)
+    def _write_data(self, stream, buf, view, offset, started, err):
+        stream["tuner"].record(len(view), time.monotonic() - started)
+        try:
+            if err.value != 0:
+                logging.error("Reading %d B from offset %d B failed: %s", len(view), offset, os.strerror(err.value))
+                stream["read_errors"].append(offset)
+                return 1
+
+            try:
+                if stream["compare_pool"] is not None and self._matches_destination(stream, view, offset):
+                    logging.debug("Skipping write of %d B to offset %d B, destination already matches", len(view), offset)
+                    with self._state.lock:
+                        stream["sync"]["skipped"] += len(view)
+                else:
+                    logging.debug("Writing %d B to offset %d B", len(view), offset)
+                    # Write straight from the buffer NBD has read into, without copy
+                    os.pwrite(self._get_write_fd(stream["destination"], offset, len(view)), view, offset)
+
+                self._record_written(stream["destination"], offset, len(view))
+            except Exception as err:
+                # libnbd would swallow it, it is raised by the copy loop
+                logging.error("Writing %d B to offset %d B failed: %s", len(view), offset, err)
+                stream["write_errors"].append((offset, err))
+        finally:
+            stream["buffer_pool"].release(buf, view)
         # By returning 1 here, we auto-retire the aio_pread command
         return 1
 
 
-    def sync_disks(self, vm_id, disks_mappings, guestfs_helper, sync_index, last_sync):
-        MAX_PREAD_LEN = 23 << 20 # 23MB (24MB requests fail in VDDK)
-        MAX_AIO_IN_FLIGHT = 2
+    def _matches_destination(self, stream, view, offset):
+        buf, destination_view = stream["compare_pool"].acquire(len(view))
+        try:
+            length = os.preadv(stream["destination"]["fd"], [destination_view], offset)
+            return length == len(view) and buffers_equal(view, destination_view)
+        finally:
+            stream["compare_pool"].release(buf, destination_view)
+
+
+    def _open_destination(self, dm):
+        logging.debug("Opening locally attached disk %s" % dm["destination"]["conversion_host_path"])
+        if self._request["source"].get("compare_before_write", False):
+            flags = os.O_RDWR | os.O_CREAT
+        else:
+            flags = os.O_WRONLY | os.O_CREAT
+        destination = {
+            "fd": os.open(dm["destination"]["conversion_host_path"], flags),
+            "direct_fd": None,
+            "flush_interval": self._request["source"].get("flush_interval", self.FLUSH_INTERVAL),
+            "unflushed": 0,
+            "written": [],
+            "completed": dm["source"]["pending"]["completed"]
+        }
 
-        vm = self._find_vm_by_id(vm_id)
-        snapshot = self.create_snapshot(vm_id, name="conversion-%s" % now.strftime('%Y%m%d-%H%M%S'))
-        self._update_change_ids(vm_id, snapshot, disks_mappings)
-        self._get_changed_extents(vm_id, snapshot, disks_mappings, sync_index, last_sync)
+        # Reads land in page-aligned pool buffers, so aligned writes can
+        # bypass the page cache. The buffered descriptor is still used for
+        # unaligned writes, zeroing and compare-before-write reads.
+        if self._request["source"].get("direct_io", False):
+            try:
+                destination["direct_fd"] = os.open(dm["destination"]["conversion_host_path"], os.O_WRONLY | os.O_DIRECT)
+            except OSError as err:
+                logging.warning("Direct I/O is not supported for %s, using buffered writes: %s", dm["destination"]["conversion_host_path"], err)
+
+        return destination
+
+
+    def _close_destination(self, destination):
+        if destination["direct_fd"] is not None:
+            os.close(destination["direct_fd"])
+        os.close(destination["fd"])
+
+
+    def _get_write_fd(self, destination, offset, length):
+        if destination["direct_fd"] is not None and offset % self.DIRECT_IO_ALIGNMENT == 0 and length % self.DIRECT_IO_ALIGNMENT == 0:
+            return destination["direct_fd"]
+        return destination["fd"]
+
+
+    def _record_written(self, destination, offset, length):
+        with self._state.lock:
+            add_range(destination["written"], offset, length)
+            destination["unflushed"] += length
+            flush = destination["unflushed"] >= destination["flush_interval"]
+        if flush:
+            self._flush_destination(destination)
+
+
+    def _flush_destination(self, destination):
+        # Written ranges only count as completed once they are on stable
+        # storage, so that a resumed sync never skips data lost in a crash.
+        with self._state.lock:
+            written = destination["written"]
+            destination["written"] = []
+            destination["unflushed"] = 0
+        if len(written) == 0:
+            return
+
+        logging.debug("Flushing %d B written to destination", sum([x[1] for x in written]))
+        os.fdatasync(destination["fd"])
+        with self._state.lock:
+            for offset, length in written:
+                add_range(destination["completed"], offset, length)
+        self._state.write()
+
+
+    def _stream_limits(self, streams):
+        """
+        Transfer limits of a stream when the buffer budget of the migration
+        is shared by `streams` streams. Tuning never goes past them.
+        """
+        limits = dict(self.TRANSFER_LIMITS[self._request["source"]["transport_method"]])
+        compare = self._request["source"].get("compare_before_write", False)
+        budget = self._request["source"].get("buffer_budget", self.BUFFER_BUDGET) // streams
+
+        max_pread_len = min(limits["max_pread_len"], budget // (2 if compare else 1))
+        limits["max_pread_len"] = max(self.DIRECT_IO_ALIGNMENT, max_pread_len - max_pread_len % self.DIRECT_IO_ALIGNMENT)
+        # The compare-before-write buffer takes one read's worth of the budget
+        buffers = budget // limits["max_pread_len"] - (1 if compare else 0)
+        limits["max_aio_in_flight"] = max(1, min(limits["max_aio_in_flight"], buffers))
+        limits["pread_len"] = min(limits["pread_len"], limits["max_pread_len"])
+        limits["aio_in_flight"] = min(limits["aio_in_flight"], limits["max_aio_in_flight"])
+        return limits
+
+
+    def _open_stream(self, destination, sync, limits):
+        """
+        State of the reads over one NBD connection of a disk. It is kept for
+        the whole sync of the disk, so that tuning carries over from one
+        batch of changed extents to the next.
+        """
+        # At most max_aio_in_flight reads are pending at once, so that many
+        # buffers are enough to never wait on the pool. Destination reads
+        # for compare-before-write only need one buffer at a time.
+        return {
+            "destination": destination,
+            "tuner": TransferTuner(
+                limits["pread_len"], limits["max_pread_len"],
+                limits["aio_in_flight"], limits["max_aio_in_flight"],
+                enabled=self._request["source"].get("autotune", True)
+            ),
+            "sync": sync,
+            "used": False,
+            "read_errors": [],
+            "write_errors": [],
+            "zeroer": Zeroer(destination["fd"]),
+            "buffer_pool": BufferPool(limits["max_aio_in_flight"], limits["max_pread_len"]),
+            "compare_pool": BufferPool(1, limits["max_pread_len"]) if self._request["source"].get("compare_before_write", False) else None
+        }
 
-        for dm in disks_mappings:
-            logging.debug("Opening locally attached disk %s" % dm["destination"]["conversion_host_path"])
-            fd = os.open(dm["destination"]["conversion_host_path"], os.O_WRONLY | os.O_CREAT)
 
-            if len(dm["source"]["extents"]) == 0:
-                os.close(fd)
+    def _close_stream(self, stream):
+        stream["buffer_pool"].close()
+        if stream["compare_pool"] is not None:
+            stream["compare_pool"].close()
+
+
+    def _copy_blocks(self, nbd_handle, stream, blocks, guestfs_helper, interrupt_event):
+        destination = stream["destination"]
+        tuner = stream["tuner"]
+        sync = stream["sync"]
+        stream["used"] = True
+
+        for block in blocks:
+            if interrupt_event is not None and interrupt_event.is_set():
+                guestfs_helper.nbd_wait_for_aio_commands_to_finish(nbd_handle)
+                self._raise_stream_errors(stream)
+                raise SyncInterrupted()
+
+            logging.debug("Block at offset %s flags: %s", block["offset"], block["flags"])
+            if block["flags"] & nbd.STATE_ZERO:
+                logging.debug("Writing %d B of zeros to offset %d B" % (block["length"], block["offset"]))
+                stream["zeroer"].zero(block["offset"], block["length"])
+                self._record_written(destination, block["offset"], block["length"])
+            else:
+                count = 0
+                while count < block["length"]:
+                    if interrupt_event is not None and interrupt_event.is_set():
+                        guestfs_helper.nbd_wait_for_aio_commands_to_finish(nbd_handle)
+                        self._raise_stream_errors(stream)
+                        raise SyncInterrupted()
+
+                    length = min(block["length"] - count, tuner.pread_len)
+                    offset = block["offset"] + count
+
+                    while nbd_handle.aio_in_flight() >= tuner.aio_in_flight:
+                        nbd_handle.poll(-1)
+
+                    self._rate_limiter.consume(length)
+
+                    logging.debug("Reading %d B from offset %d B" % (length, offset))
+                    buf, view = stream["buffer_pool"].acquire(length)
+                    nbd_handle.aio_pread(
+                        view, offset,
+                        lambda err, buf=buf, view=view, offset=offset, started=time.monotonic(): self._write_data(stream, buf, view, offset, started, err)
+                    )
+                    count += length
+
+                    guestfs_helper.nbd_process_aio_requests(nbd_handle)
+                    if len(stream["read_errors"]) > 0 or len(stream["write_errors"]) > 0:
+                        guestfs_helper.nbd_wait_for_aio_commands_to_finish(nbd_handle)
+                        self._raise_stream_errors(stream)
+
+                    with self._state.lock:
+                        sync["copied"] += length
+                        self._state.progress["copied"] += length
+                    self._state.write()
+
+        guestfs_helper.nbd_wait_for_aio_commands_to_finish(nbd_handle)
+        self._raise_stream_errors(stream)
+
+
+    def _raise_stream_errors(self, stream):
+        if len(stream["read_errors"]) > 0:
+            raise Exception("NBD read failed at offset %d B" % stream["read_errors"][0])
+        if len(stream["write_errors"]) > 0:
+            raise Exception("Destination write failed at offset %d B: %s" % stream["write_errors"][0])
+
+
+    def _copy_extents(self, vm, snapshot, dm, coalesced, allocation_map, streams, executor, guestfs_helper, sync_index, interrupt_event):
+        nbd_handle = guestfs_helper.nbd_connect(dm["source"], vm_moref=vm._moId, snapshot_moref=snapshot._moId, sync_index=sync_index)[0]
+        sync = streams[0]["sync"]
+
+        logging.info("Getting block info for disk: %s" % dm["source"]["id"])
+        data_blocks = []
+        for extent in coalesced:
+            if extent.length < 1 << 20:
+                logging.debug("Skipping block status for extent of size %d B at offset %d B" % (extent.length, extent.start))
+                data_blocks.append({
+                    "offset": extent.start,
+                    "length": extent.length,
+                    "flags": 0
+                })
                 continue
 
-            logging.info("Connecting the source disk %s with NBD", dm["source"]["id"])
-            nbd_cmd = guestfs_helper.nbd_expose_disk_cmd(dm["source"], None, vm_moref=vm._moId, sync_index=sync_index)
-            logging.debug("NBD Command: %s", nbd_cmd)
-            nbd_handle = nbd.NBD()
-            nbd_handle.add_meta_context("base:allocation")
-            nbd_handle.connect_command(nbd_cmd)
-
-            logging.info("Getting block info for disk: %s" % dm["source"]["id"])
-            copied = 0
-            position = 0
-            data_blocks = []
-            for extent in dm["source"]["extents"]:
-                if extent.length < 1 << 20:
-                    logging.debug("Skipping block status for extent of size %d B at offset %d B" % (extent.length, extent.start))
-                    data_blocks.append({
-                        "offset": extent.start,
-                        "length": extent.length,
-                        "flags": 0
-                    })
+            missing = allocation_map.missing(extent.start, extent.length)
+            if len(missing) > 0:
+                # A single query covering all the unknown parts of the range
+                start = missing[0][0]
+                end = missing[-1][0] + missing[-1][1]
+                allocation_map.update(self._get_block_status(nbd_handle, Extent(start, end - start)))
+            else:
+                logging.debug("Using cached block status for extent of size %d B at offset %d B" % (extent.length, extent.start))
+
+            blocks = allocation_map.blocks(extent.start, extent.length)
+            logging.debug("Gathered block status of %d: %s" % (len(blocks), blocks))
+            data_blocks += [x for x in blocks if not x['flags'] & nbd.STATE_HOLE]
+
+        data_blocks = merge_blocks(data_blocks, nbd.STATE_ZERO)
+        logging.debug("Block status filtered down to %d data blocks" % len(data_blocks))
+        if len(data_blocks) == 0:
+            logging.debug("No extents have allocated data for disk: %s" % dm["source"]["id"])
+            return
+
+        to_copy = sum([x['length'] for x in data_blocks])
+        logging.debug("Copying %d B of data for disk %s" % (to_copy, dm["source"]["id"]))
+
+        with self._state.lock:
+            sync["to_copy"] += to_copy
+            self._state.progress["to_copy"] += to_copy
+        self._state.write()
+
+        # Large batches are split in stripes, each read over its own NBD
+        # connection, so that a single disk isn't limited to one stream.
+        stripes = split_blocks(data_blocks, min(len(streams), max(1, to_copy // self.MIN_STRIPE_LEN)))
+        nbd_handles = guestfs_helper.nbd_connect(dm["source"], len(stripes), vm_moref=vm._moId, snapshot_moref=snapshot._moId, sync_index=sync_index)
+
+        if len(stripes) == 1:
+            self._copy_blocks(nbd_handles[0], streams[0], stripes[0], guestfs_helper, interrupt_event)
+            return
+
+        logging.info("Copying disk %s over %d NBD connections", dm["source"]["id"], len(stripes))
+        futures = [
+            executor.submit(contextvars.copy_context().run, self._copy_blocks, nbd_handle, stream, stripe, guestfs_helper, interrupt_event)
+            for nbd_handle, stream, stripe in zip(nbd_handles, streams, stripes)
+        ]
+        concurrent.futures.wait(futures)
+        for future in futures:
+            future.result()
+
+
+    def _sync_disk(self, vm, snapshot, dm, pages, guestfs_helper, sync_index, interrupt_event):
+        sync = {
+            "to_copy": 0,
+            "copied": 0,
+            "skipped": 0
+        }
+        with self._state.lock:
+            self._state.disks[dm["source"]["id"]]["syncs"].append(sync)
+
+        dm["source"]["extents"] = []
+        destination = self._open_destination(dm)
+
+        # Streams, and the threads reading stripes over them, are set up once
+        # for all the batches of changed extents of the disk
+        limits = self.TRANSFER_LIMITS[self._request["source"]["transport_method"]]
+        connections = self._request["source"].get("nbd_connections", limits["connections"])
+        # Every stream of every disk synced at once shares the buffer budget
+        stream_limits = self._stream_limits(connections * self._request["source"].get("max_sync_workers", self.MAX_SYNC_WORKERS))
+        streams = [self._open_stream(destination, sync, stream_limits) for i in range(connections)]
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=connections)
+
+        try:
+            allocation_map = AllocationMap("/tmp/%s/disks/%s.allocation" % (self._request["vm_name"], dm["source"]["id"]))
+            if dm["source"]["change_ids"][-2] == "*":
+                allocation_map.invalidate(0, dm["source"]["size"])
+
+            held = []
+            done = False
+            while not done:
+                extents, done = self._next_extents_batch(pages)
+                dm["source"]["extents"] += extents
+
+                # The allocation of ranges that CBT reports as changed may
+                # have changed too. Everything else is still known from
+                # previous syncs.
+                for extent in extents:
+                    allocation_map.invalidate(extent.start, extent.length)
+
+                coalesced = coalesce_extents(
+                    held + extents,
+                    self._request["source"].get("extent_gap", self.EXTENT_GAP)
+                )
+                # The last range may still merge with the first extents of
+                # the next batch, so it is held back until then
+                if not done:
+                    held = coalesced[-1:]
+                    coalesced = coalesced[:-1]
+                if len(coalesced) == 0:
                     continue
+                logging.debug("Coalesced changed extents into %d ranges", len(coalesced))
 
-                blocks = self._get_block_status(nbd_handle, extent)
-                logging.debug("Gathered block status of %d: %s" % (len(blocks), blocks))
-                data_blocks += [x for x in blocks if not x['flags'] & nbd.STATE_HOLE]
+                # Disks still queued when cutover is requested don't need to
+                # connect to NBD at all
+                if interrupt_event is not None and interrupt_event.is_set():
+                    raise SyncInterrupted()
+                self._copy_extents(vm, snapshot, dm, coalesced, allocation_map, streams, executor, guestfs_helper, sync_index, interrupt_event)
 
-            logging.debug("Block status filtered down to %d data blocks" % len(data_blocks))
-            if len(data_blocks) == 0:
-                logging.debug("No extents have allocated data for disk: %s" % dm["source"]["id"])
-                os.close(fd)
-                continue
+            total_size = sum(x.length for x in dm["source"]["extents"])
+            logging.debug("Gathered %d extents to transfer, with a total size of %d B" % (len(dm["source"]["extents"]), total_size))
+            allocation_map.save()
 
-            to_copy = sum([x['length'] for x in data_blocks])
-            logging.debug("Copying %d B of data for disk %s" % (to_copy, dm["source"]["id"]))
-
-            self._state.disks[dm["source"]["id"]]["syncs"].append({
-                "to_copy": to_copy,
-                "copied": 0
-            })
-            self._state.write()
-
-            for block in data_blocks:
-                logging.debug("Block at offset %s flags: %s", block["offset"], block["flags"])
-                if block["flags"] & nbd.STATE_ZERO:
-                    logging.debug("Writing %d B of zeros to offset %d B" % (block["length"], block["offset"]))
-                    # Optimize for memory usage, maybe?
-                    os.pwrite(fd, [0] * block["length"], block["offset"])
-                else:
-                    count = 0
-                    while count < block["length"]:
-                        length = min(block["length"] - count, MAX_PREAD_LEN)
-                        offset = block["offset"] + count
-
-                        logging.debug("Reading %d B from offset %d B" % (length, offset))
-                        buf = nbd.Buffer(length)
-                        nbd_handle.aio_pread(
-                            buf, offset,
-                            lambda err, fd=fd, buf=buf, offset=offset: self._write_data(fd, buf, offset, err)
-                        )
-                        count += length
-
-                        while nbd_handle.aio_in_flight() > MAX_AIO_IN_FLIGHT:
-                            nbd_handle.poll(-1)
-                        guestfs_helper.nbd_process_aio_requests(nbd_handle)
-
-                        copied += length
-                        self._state.disks[dm["source"]["id"]]["syncs"][sync_index]["copied"] = copied
-                        self._state.write()
-                
-            guestfs_helper.nbd_wait_for_aio_commands_to_finish(nbd_handle)
+            # The sync is only committed once everything it wrote is durable
+            self._flush_destination(destination)
+
+            with self._state.lock:
+                sync["tuning"] = [stream["tuner"].summary() for stream in streams if stream["used"]]
+                copied = sync["copied"]
 
             if copied == 0:
                 logging.debug("Nothing to copy for disk: %s" % dm["source"]["id"])
             else:
                 logging.debug("Copied %d B for disk: %s" % (copied, dm["source"]["id"]))
 
-            nbd_handle.shutdown()
+        except SyncInterrupted:
+            with self._state.lock:
+                sync["interrupted"] = True
+            # Keep what was written for the resumed sync
+            self._flush_destination(destination)
+            raise
+
+        except Exception as err:
+            with self._state.lock:
+                sync["failed"] = True
+                sync["message"] = str(err)
+            # Don't reuse a connection that may be in a bad state
+            guestfs_helper.nbd_disconnect(dm["source"])
+            raise
+
+        finally:
+            executor.shutdown()
+            for stream in streams:
+                self._close_stream(stream)
+            self._close_destination(destination)
+
+
+    def _verify_chunks(self, nbd_handle, dm, chunks, result):
+        fd = os.open(dm["destination"]["conversion_host_path"], os.O_RDONLY)
+        try:
+            for offset, length in chunks:
+                source_digest = hashlib.blake2b(nbd_handle.pread(length, offset)).digest()
+                destination_digest = hashlib.blake2b(os.pread(fd, length, offset)).digest()
+                with self._state.lock:
+                    result["checked"] += length
+                    if source_digest != destination_digest:
+                        logging.error("Disk %s differs from its source at offset %d B", dm["source"]["id"], offset)
+                        result["mismatches"].append(offset)
+                self._state.write()
+        finally:
             os.close(fd)
 
-        self._remove_all_snapshots(vm_id)
+
+    def _get_verification_chunks(self, dm, mode):
+        size = dm["source"]["size"]
+        if mode == "changed":
+            ranges = [(e.start, e.length) for e in coalesce_extents(dm["source"]["extents"])]
+        else:
+            ranges = [(0, size)]
+
+        chunks = []
+        for start, length in ranges:
+            for offset in range(start, start + length, self.VERIFY_CHUNK_LEN):
+                chunks.append((offset, min(self.VERIFY_CHUNK_LEN, start + length - offset)))
+
+        if mode == "sample" and len(chunks) > 0:
+            ratio = self._request.get("verify_sample_ratio", self.VERIFY_SAMPLE_RATIO)
+            chunks = sorted(random.sample(chunks, max(1, int(len(chunks) * ratio))))
+
+        return chunks
+
+
+    def _verify_disk(self, vm, snapshot, dm, chunks, result, guestfs_helper, connections):
+        # Connections are only opened once the disk's turn comes, and closed
+        # right after, so that at most max_sync_workers disks hold servers
+        stripes = [chunks[i::connections] for i in range(min(connections, len(chunks)))]
+        try:
+            nbd_handles = guestfs_helper.nbd_connect(dm["source"], len(stripes), vm_moref=vm._moId, snapshot_moref=snapshot._moId)
+            with concurrent.futures.ThreadPoolExecutor(max_workers=len(stripes)) as executor:
+                futures = [
+                    executor.submit(contextvars.copy_context().run, self._verify_chunks, nbd_handle, dm, stripe, result)
+                    for nbd_handle, stripe in zip(nbd_handles, stripes)
+                ]
+                concurrent.futures.wait(futures)
+            for future in futures:
+                future.result()
+        finally:
+            guestfs_helper.nbd_disconnect(dm["source"])
+
+
+    def _verify_disks(self, vm, snapshot, disks_mappings, guestfs_helper, mode):
+        """
+        Compare chunks of the destination disks with the snapshot they were
+        synced from. Each disk is read over several NBD connections, and up
+        to max_sync_workers disks are verified at the same time.
+        """
+        logging.info("Verifying destination disks (mode=%s)", mode)
+        with self._state.lock:
+            self._state.verification = {
+                "mode": mode,
+                "disks": {}
+            }
+
+        connections = self._request.get("verify_connections", self.VERIFY_CONNECTIONS)
+        tasks = []
+        for dm in disks_mappings:
+            chunks = self._get_verification_chunks(dm, mode)
+            result = {
+                "to_check": sum(length for offset, length in chunks),
+                "checked": 0,
+                "mismatches": []
+            }
+            with self._state.lock:
+                self._state.verification["disks"][dm["source"]["id"]] = result
+            if len(chunks) > 0:
+                tasks.append((vm, snapshot, dm, chunks, result, guestfs_helper, connections))
+
+        max_workers = self._request["source"].get("max_sync_workers", self.MAX_SYNC_WORKERS)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, self._verify_disk, *task) for task in tasks]
+            concurrent.futures.wait(futures)
+        self._state.flush()
+
+        # Surface errors once all the verification threads are done
+        for future in futures:
+            future.result()
+
+        # A verification that compared nothing mustn't pass. Only changed
+        # mode can legitimately have nothing to check.
+        results = self._state.verification["disks"]
+        unchecked = [k for k, v in results.items() if v["checked"] < v["to_check"]]
+        if unchecked:
+            raise Exception("Verification didn't check all the chunks of disks: %s" % ", ".join(unchecked))
+        if mode != "changed" and sum(v["checked"] for v in results.values()) == 0:
+            raise Exception("Verification didn't compare any data")
+
+        return {
+            disk_id: result["mismatches"]
+            for disk_id, result in results.items()
+            if len(result["mismatches"]) > 0
+        }
+
+
+    def _commit_sync(self, dm):
+        with self._state.lock:
+            del dm["source"]["pending"]
+            self._state.disks[dm["source"]["id"]]["change_ids"] = list(dm["source"]["change_ids"])
+            self._state.disks[dm["source"]["id"]]["pending"] = None
+
+
+    def _reset_sync(self, dm):
+        logging.warning("Disk %s will be copied again in full", dm["source"]["id"])
+        with self._state.lock:
+            del dm["source"]["pending"]
+            dm["source"]["change_ids"] = ["*"]
+            self._state.disks[dm["source"]["id"]]["change_ids"] = ["*"]
+            self._state.disks[dm["source"]["id"]]["pending"] = None
+
+
+    @invalidates_morefs
+    def sync_disks(self, vm_id, disks_mappings, guestfs_helper, sync_index, last_sync, interrupt_event=None):
+        vm = self._find_vm_by_id(vm_id)
+        now = datetime.now()
+        snapshot = self._snapshots.take(vm_id, "conversion-%s" % now.strftime('%Y%m%d-%H%M%S'))
+        try:
+            self._update_change_ids(vm_id, snapshot, disks_mappings)
+
+            # Ranges copied during this sync are tracked until the sync completes,
+            # so that an interrupted or crashed sync can be resumed.
+            resumed = {}
+            with self._state.lock:
+                self._state.progress = {
+                    "sync_index": sync_index,
+                    "to_copy": 0,
+                    "copied": 0
+                }
+                for dm in disks_mappings:
+                    resumed[dm["source"]["id"]] = dm["source"].get("pending")
+                    dm["source"]["pending"] = {
+                        "change_id": dm["source"]["change_ids"][-1],
+                        "completed": []
+                    }
+                    self._state.disks[dm["source"]["id"]]["pending"] = dm["source"]["pending"]
+            self._state.flush()
+
+            # Changed extents of all disks are enumerated in the background, in
+            # parallel. Disks are copied batch by batch as pages of results come
+            # in, so that copying starts before the enumeration finishes.
+            stop_event = threading.Event()
+            pages = {}
+            for dm in disks_mappings:
+                pages[dm["source"]["id"]] = queue.Queue()
+                threading.Thread(
+                    target=contextvars.copy_context().run,
+                    args=(self._enumerate_changed_extents, vm, snapshot, dm, resumed[dm["source"]["id"]], pages[dm["source"]["id"]], stop_event),
+                    daemon=True
+                ).start()
+
+            # Each disk has its own NBD connection and destination file descriptor,
+            # so disks are copied concurrently. A failing disk doesn't cancel the
+            # others: errors are collected and raised once all disks are done.
+            max_workers = self._request["source"].get("max_sync_workers", self.MAX_SYNC_WORKERS)
+            logging.info("Syncing %d disks with %d workers", len(disks_mappings), max_workers)
+            errors = {}
+            interrupted = False
+            synced = []
+            with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as executor:
+                futures = {
+                    executor.submit(contextvars.copy_context().run, self._sync_disk, vm, snapshot, dm, pages[dm["source"]["id"]], guestfs_helper, sync_index, interrupt_event): dm
+                    for dm in disks_mappings
+                }
+                for future in concurrent.futures.as_completed(futures):
+                    dm = futures[future]
+                    disk_id = dm["source"]["id"]
+                    try:
+                        future.result()
+                    except SyncInterrupted:
+                        # The snapshot isn't fully copied, so the next sync has to
+                        # start from the previous change id of this disk.
+                        logging.info("Sync %d interrupted for disk %s", sync_index, disk_id)
+                        interrupted = True
+                        if len(dm["source"]["change_ids"]) > 1:
+                            dm["source"]["change_ids"].pop()
+                    except Exception as err:
+                        logging.error("Sync %d failed for disk %s: %s", sync_index, disk_id, err)
+                        errors[disk_id] = err
+                    else:
+                        synced.append(dm)
+            # Enumerations of disks that failed or were interrupted aren't needed
+            stop_event.set()
+
+            # The last sync is verified against its own snapshot, before the
+            # snapshot is removed.
+            mismatches = {}
+            if last_sync and not errors and not interrupted and self._request.get("verify") is not None:
+                try:
+                    mismatches = self._verify_disks(vm, snapshot, disks_mappings, guestfs_helper, self._request["verify"])
+                except Exception as err:
+                    logging.error("Verification failed: %s", err)
+                    errors["verification"] = err
+
+            # Change ids are only committed once the disks are verified, since
+            # a resumed migration only copies what changed after them. Disks
+            # that don't match their source are copied again in full. An
+            # interrupted last sync isn't verified, so it isn't committed.
+            for dm in synced:
+                if dm["source"]["id"] in mismatches:
+                    self._reset_sync(dm)
+                elif "verification" not in errors and not (last_sync and interrupted):
+                    self._commit_sync(dm)
+
+        finally:
+            # The snapshot is released whatever happens, so that a failed
+            # sync doesn't leave it on the source VM
+            self._state.flush()
+            guestfs_helper.nbd_release_snapshot(snapshot._moId)
+            self._snapshots.release(snapshot)
+
+        if last_sync:
+            # Leave the source VM without our snapshots once migrated
+            self._snapshots.wait()
+        logging.debug("Managed object cache: %s", self.moref_cache_stats())
+
+        if mismatches:
+            raise Exception("Verification found mismatches in disks:\n%s" % (
+                "\n".join([" - %s: %d chunks differ, first at offset %d B" % (k, len(v), v[0]) for k, v in mismatches.items()])
+            ))
+
+        if errors:
+            raise Exception("Sync %d failed for disks:\n%s" % (
+                sync_index,
+                "\n".join([" - %s: %s" % (k, v) for k, v in errors.items()])
+            ))
+
+        return not interrupted
 
 
     def add_nic_to_vm(self, vm_id, nic_spec):
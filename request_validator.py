@@ -2,6 +2,8 @@ from importlib import import_module
 
 class RequestValidator:
 
+    SUPPORTED_VERIFY_MODES = [None, "full", "sample", "changed"]
+
     def __init__(self, request):
         self._request = request
         self._errors = []
@@ -16,12 +18,36 @@ class RequestValidator:
         if "vm_uuid" not in self._request:
             self._errors.append("Missing 'vm_uuid' key in request")
 
+        if self._request.get("verify") not in self.SUPPORTED_VERIFY_MODES:
+            self._errors.append("Verification mode '%s' is not supported" % self._request["verify"])
+
+        self._validate_number("verify_connections", "a positive integer", lambda v: v >= 1, integer=True)
+        self._validate_number("verify_sample_ratio", "a number in ]0, 1]", lambda v: 0 < v <= 1)
+        self._validate_number("sync_target_delta", "a positive integer", lambda v: v >= 1, integer=True)
+        self._validate_number("min_sync_interval", "a non-negative number", lambda v: v >= 0)
+        self._validate_number("max_sync_interval", "a non-negative number", lambda v: v >= 0)
+        if self._is_number(self._request.get("min_sync_interval")) and self._is_number(self._request.get("max_sync_interval")):
+            if self._request["min_sync_interval"] > self._request["max_sync_interval"]:
+                self._errors.append("'min_sync_interval' in request must not be greater than 'max_sync_interval'")
+
         self._errors.extend(RequestSourceValidator(self._request).validate())
         self._errors.extend(RequestDestinationValidator(self._request).validate())
 
         return list(dict.fromkeys(self._errors))
 
 
+    def _is_number(self, value, integer=False):
+        # bool is a subclass of int, but true and false aren't numbers here
+        return isinstance(value, int if integer else (int, float)) and not isinstance(value, bool)
+
+
+    def _validate_number(self, key, expected, check, integer=False):
+        if key not in self._request:
+            return
+        if not self._is_number(self._request[key], integer) or not check(self._request[key]):
+            self._errors.append("'%s' in request must be %s" % (key, expected))
+
+
 class RequestSourceValidator:
 
     SUPPORTED_SOURCE_TYPES = ["vmware"]
@@ -2,24 +2,51 @@
 
 import os
 import sys
+import glob
 import json
 import asyncio
 import logging
+import threading
+import functools
+import contextvars
+import time
 from datetime import datetime, timezone
 
+import log_context
 from state import State
+from cutover import CutoverWatcher
+from limits import LimitsWatcher
+from sync_scheduler import SyncScheduler
 from request_validator import RequestValidator
 from providers.vm_manager import VmManager
 from providers.guestfs_helper import GuestfsHelper
 
 
+class _AnyEvent:
+    """
+    Set as soon as one of `events` is, for the interrupt checks of the
+    syncs.
+    """
+
+    def __init__(self, *events):
+        self._events = [event for event in events if event is not None]
+
+
+    def is_set(self):
+        return any(event.is_set() for event in self._events)
+
+
 class ConversionHostRunner:
 
     VERSION = "2.0"
     LOG_LEVEL = logging.DEBUG
     SYNC_INTERVAL = 60 # 1 minute
+    MIN_SYNC_INTERVAL = 10 # 10 seconds
+    MAX_SYNC_INTERVAL = 900 # 15 minutes
+    SYNC_TARGET_DELTA = 1 << 30 # 1GB
+    PROGRESS_INTERVAL = 30 # 30 seconds
 
-    def __init__(self, request):
+    def __init__(self, request, shared_logging=False):
         self._request = request
 
         # Validate that request contains the mandatory info
@@ -43,6 +70,16 @@ class ConversionHostRunner:
         # Store start datetime as timestamp
         self._conversion_time = datetime.now(timezone.utc)
         self._conversion_timestamp = self._conversion_time.strftime('%Y%m%dT%H%M%S')
+        self._log_timestamp = self._conversion_timestamp
+
+        # Resume an unfinished migration of the same VM, keeping its files
+        self._resume = False
+        if self._request.get("resume", True):
+            for state_file in sorted(glob.glob("%s/*.state" % self._work_dir), reverse=True):
+                if State.is_resumable(state_file):
+                    self._conversion_timestamp = os.path.basename(state_file)[:-len(".state")]
+                    self._resume = True
+                    break
 
         # Configure logging
         self._log_dir = "/var/log/conversion-host/%s" % self._request["vm_name"]
@@ -50,9 +87,19 @@ class ConversionHostRunner:
         if not os.path.isdir(self._log_dir):
             os.makedirs(self._log_dir)
 
-        self._log_file = "%s/%s" % (self._log_dir, self._conversion_timestamp)
+        self._log_file = "%s/%s" % (self._log_dir, self._log_timestamp)
         log_format = '%(asctime)s:%(levelname)s: %(message)s (%(module)s:%(lineno)d)'
-        logging.basicConfig(filename=self._log_file, format=log_format, level=self.LOG_LEVEL)
+        if shared_logging:
+            # Other migrations log from the same process, only the records
+            # of this one go to its log file
+            log_context.migration.set(self._log_file)
+            self._log_handler = logging.FileHandler(self._log_file)
+            self._log_handler.setFormatter(logging.Formatter(log_format))
+            self._log_handler.addFilter(log_context.MigrationLogFilter(self._log_file))
+            logging.getLogger().addHandler(self._log_handler)
+        else:
+            self._log_handler = None
+            logging.basicConfig(filename=self._log_file, format=log_format, level=self.LOG_LEVEL)
 
         logging.info("Conversion Host Runner version %s, uid=%s", self.VERSION, os.getuid())
 
@@ -64,23 +111,129 @@ class ConversionHostRunner:
         self._cutover_file = "%s/%s.cutover" % (self._work_dir, self._conversion_timestamp)
         logging.info("Cutover file: %s", self._cutover_file)
 
-        open(self._cutover_file, 'a').close()
-
         # Initialize state
-        self._state = State(self._state_file)
+        self._state = State(self._state_file, resume=self._resume)
+        self._interrupted = threading.Event()
 
 
-    async def _sleep_coroutine(self, delay):
-        await asyncio.sleep(delay)
+    @property
+    def state(self):
+        return self._state
 
 
     def run(self):
+        asyncio.run(self._run())
+
+
+    def interrupt(self):
+        """
+        Stop the migration at the latest once the running sync is
+        interrupted. The migration fails and can be resumed later, unless
+        the conversion has already started, in which case it is completed.
+        """
+        logging.info("Interrupting migration of %s", self._request["vm_name"])
+        self._interrupted.set()
+
+
+    def _check_interrupted(self):
+        if self._interrupted.is_set():
+            raise Exception("Migration of %s was interrupted" % self._request["vm_name"])
+
+
+    async def _wait_for_sync(self, cutover_watcher, interval):
+        # Interruptions are noticed within a poll interval of the cutover
+        # watcher
+        deadline = time.monotonic() + interval
+        while not self._interrupted.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0 or await self._call(cutover_watcher.wait, min(remaining, CutoverWatcher.POLL_INTERVAL)):
+                return
+
+
+    async def _call(self, func, *args, **kwargs):
+        # Blocking calls, like the provider SDK ones, run in the default
+        # executor so that the other tasks of the migration keep running
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, functools.partial(contextvars.copy_context().run, func, *args, **kwargs))
+
+
+    async def _flush_state(self):
+        # State.write() is rate limited, so the last writes of a burst would
+        # only be persisted by the next write
+        while True:
+            await asyncio.sleep(State.MIN_FLUSH_INTERVAL)
+            await self._call(self._state.flush_if_dirty)
+
+
+    async def _log_progress(self):
+        while True:
+            await asyncio.sleep(self.PROGRESS_INTERVAL)
+            with self._state.lock:
+                progress = dict(self._state.progress)
+            if progress["sync_index"] is not None:
+                logging.info("Sync %d: copied %d B of %d B", progress["sync_index"], progress["copied"], progress["to_copy"])
+
+
+    async def _map_disk(self, source_disk, destination_disks_index, destination_vm_manager):
+        disk_state = self._state.disks.get(source_disk["id"])
+        if disk_state is not None and "destination" in disk_state:
+            # Carry on from the last change ids that were fully copied
+            destination_disk = disk_state["destination"]
+            logging.info("Resuming sync of disk %s to disk %s", source_disk["id"], destination_disk["id"])
+            source_disk["change_ids"] = list(disk_state["change_ids"])
+            if disk_state.get("pending") is not None:
+                source_disk["pending"] = disk_state["pending"]
+        else:
+            self._state.disks[source_disk["id"]] = {
+                "path": source_disk["path"],
+                "syncs": [],
+                "change_ids": ["*"],
+                "pending": None
+            }
+            destination_disk = {
+                "name": "%s_Disk%s" % (self._request["vm_name"], destination_disks_index),
+                "storage_name": self._request["mappings"]["storage"][source_disk["storage_name"]],
+                "size": source_disk["size"],
+                "format": destination_vm_manager.best_fit_disk_format["storage_name"],
+                "allocation": destination_vm_manager.best_fit_disk_allocation["storage_name"]
+            }
+            destination_disk["id"] = await self._call(destination_vm_manager.create_disk, destination_disk)
+            # Persist the disk right away, so a crash doesn't leak it
+            self._state.disks[source_disk["id"]]["destination"] = destination_disk
+            self._state.flush()
+        return {
+            "source": source_disk,
+            "destination": destination_disk
+        }
+
+
+    async def _run(self):
+        # Apply the limits file for the whole migration
+        limits_watcher = LimitsWatcher(self._limits_file, self._state, "%s-%s" % (self._request["vm_name"], self._conversion_timestamp))
+        limits_watcher.start()
+
+        # State and progress are taken care of alongside the migration steps
+        background_tasks = [
+            asyncio.ensure_future(self._flush_state()),
+            asyncio.ensure_future(self._log_progress())
+        ]
+
+        vm_managers = []
+        source_vm_manager = None
+        source_guestfs_helper = None
         try:
-            # Instantiate source VmManager
-            source_vm_manager = VmManager(self._request, "source", self._state)
-
-            # Instantiate destination VmManager
-            destination_vm_manager = VmManager(self._request, "destination", self._state)
+            # Instantiate source and destination VmManagers, connecting to
+            # both at once. The one that connected is closed if the other
+            # can't.
+            vm_managers = await asyncio.gather(
+                self._call(VmManager, self._request, "source", self._state),
+                self._call(VmManager, self._request, "destination", self._state),
+                return_exceptions=True
+            )
+            for vm_manager in vm_managers:
+                if isinstance(vm_manager, Exception):
+                    raise vm_manager
+            source_vm_manager, destination_vm_manager = vm_managers
 
             # Instantiate source GuestfsHelper
             source_guestfs_helper = GuestfsHelper(self._request, "source", self._state)
@@ -89,44 +242,31 @@ class ConversionHostRunner:
             destination_guestfs_helper = GuestfsHelper(self._request, "destination", self._state)
 
             # Enable CBT for the source VM
-            source_vm_manager.enable_change_block_tracking(self._request["vm_uuid"])
+            await self._call(source_vm_manager.enable_change_block_tracking, self._request["vm_uuid"])
 
             # Retrieve source VM hardware
-            source_vm_hardware = source_vm_manager.get_vm_hardware(self._request["vm_uuid"])
+            source_vm_hardware = await self._call(source_vm_manager.get_vm_hardware, self._request["vm_uuid"])
             logging.debug("Source VM Hardware:\n%s", json.dumps(source_vm_hardware, sort_keys=True, indent=4, separators=(',', ': ')))
 
             # Retrieve VM software
-            snapshot = source_vm_manager.create_snapshot(self._request["vm_uuid"], 'inspection')
-            source_vm_operating_system = source_guestfs_helper.get_vm_operating_system(source_vm_hardware, snapshot_moref=snapshot._moId)
-            source_vm_manager.remove_snapshot(self._request["vm_uuid"], 'inspection')
+            snapshot = await self._call(source_vm_manager.create_snapshot, self._request["vm_uuid"], 'inspection')
+            source_vm_operating_system = await self._call(source_guestfs_helper.get_vm_operating_system, source_vm_hardware, snapshot_moref=snapshot._moId)
+            # The first sync reads from the inspection snapshot, so its NBD
+            # servers are kept and it isn't removed here
+            source_vm_manager.adopt_snapshot(snapshot)
             logging.debug("Source VM Operating Systems:\n%s", json.dumps(source_vm_operating_systems, sort_keys=True, indent=4, separators=(',', ': ')))
             source_vm_operating_systems = source_vm_operating_systems.copy()
 
             sys.exit(0)
 
-            # Create a list to keep track of source/destination disks
-            disks_mappings = []
-            destination_disks_index = 1
-            for source_disk in source_vm_hardware["disks"]:
-                self._state.disks[source_disk["id"]] = {
-                    "path": source_disk["path"],
-                    "syncs": []
-                }
-                destination_disk = {
-                    "name": "%s_Disk%s" % (self._request["vm_name"], destination_disks_index),
-                    "storage_name": self._request["mappings"]["storage"][source_disk["storage_name"]],
-                    "size": source_disk["size"],
-                    "format": destination_vm_manager.best_fit_disk_format["storage_name"],
-                    "allocation": desintation_vm_manager.best_fit_disk_allocation["storage_name"]
-                }
-                destination_disk["id"] = destination_vm_manager.create_disk(destination_disk)
-                disks_mappings.append({
-                    "source": source_disk,
-                    "destination": destination_disk
-                })
-                destination_disks_index = destination_disks_index + 1
+            # Create a list to keep track of source/destination disks. The
+            # destination disks are created at once.
+            disks_mappings = list(await asyncio.gather(*[
+                self._map_disk(source_disk, destination_disks_index, destination_vm_manager)
+                for destination_disks_index, source_disk in enumerate(source_vm_hardware["disks"], start=1)
+            ]))
             self._state.disk_count = len(source_vm_hardware["disks"])
-            self._state.write()
+            self._state.flush()
 
             # Extract and enrich destination disks attributes
             destination_disks_ids = []
@@ -135,10 +275,14 @@ class ConversionHostRunner:
                 destination_disk["conversion_host_path"] = "/dev/disk/by-id/scsi-0QEMU_QEMU_HARDDISK_%s" % destination_disk["id"][0:20]
             logging.debug(destination_disks_ids)
 
-            # Attach newly created disks to conversion host
+            # Attach newly created disks to conversion host. Disks of a resumed
+            # migration may still be attached.
             logging.info("Disks attach to conversion host (vm_id=%s)", self._request["conversion_host_uuid"])
-            for destination_disk_id in destination_disks_ids:
-                destination_vm_manager.attach_disk_to_vm(self._request["conversion_host_uuid"], destination_disk_id)
+            for destination_disk in [dm["destination"] for dm in disks_mappings]:
+                if os.path.exists(destination_disk["conversion_host_path"]):
+                    logging.info("Disk %s is already attached to conversion host", destination_disk["id"])
+                    continue
+                await self._call(destination_vm_manager.attach_disk_to_vm, self._request["conversion_host_uuid"], destination_disk["id"])
 
             # Generate destination VM hardware
             destination_vm_hardware = source_vm_hardware.copy()
@@ -156,34 +300,71 @@ class ConversionHostRunner:
 
             # Transfer data
             logging.info("Transferring data...")
-            sync_index = 0
-            last_sync = False
-            while True:
-                if os.path.exists(self._cutover_file):
-                    logging.info("Cutover is requested. Performing last sync.")
-                    last_sync = True
-                source_vm_manager.sync_disks(self._request["vm_uuid"], disks_mappings, source_guestfs_helper, sync_index, last_sync)
-                if last_sync:
-                    break
-                sync_index += 1
-                asyncio.run(self._sleep_coroutine(self.SYNC_INTERVAL))
+            sync_scheduler = SyncScheduler(
+                self._state,
+                self._request.get("sync_target_delta", self.SYNC_TARGET_DELTA),
+                self.SYNC_INTERVAL,
+                self._request.get("min_sync_interval", self.MIN_SYNC_INTERVAL),
+                self._request.get("max_sync_interval", self.MAX_SYNC_INTERVAL)
+            )
+            # A warm sync can optionally be interrupted by cutover, so that
+            # the last sync starts right away.
+            cutover_watcher = CutoverWatcher(self._cutover_file)
+            cutover_watcher.start()
+            # Any sync, the last one included, is interrupted when the whole
+            # migration is.
+            if self._request.get("interrupt_sync_on_cutover", False):
+                interrupt_event = _AnyEvent(self._interrupted, cutover_watcher.event)
+            else:
+                interrupt_event = self._interrupted
+
+            try:
+                sync_index = max(len(disk["syncs"]) for disk in self._state.disks.values())
+                last_sync = False
+                while True:
+                    self._check_interrupted()
+                    if cutover_watcher.requested():
+                        logging.info("Cutover is requested. Performing last sync.")
+                        last_sync = True
+                    sync_scheduler.start()
+                    completed = await self._call(
+                        source_vm_manager.sync_disks,
+                        self._request["vm_uuid"], disks_mappings, source_guestfs_helper, sync_index, last_sync,
+                        self._interrupted if last_sync else interrupt_event
+                    )
+                    self._check_interrupted()
+                    if completed:
+                        sync_scheduler.record(sync_index, self._state.progress["to_copy"])
+                    else:
+                        logging.info("Sync %d was interrupted by cutover", sync_index)
+                    if last_sync:
+                        break
+                    sync_index += 1
+                    await self._wait_for_sync(cutover_watcher, sync_scheduler.interval)
+            finally:
+                cutover_watcher.stop()
+            await self._call(source_guestfs_helper.nbd_close_connections)
 
             # Convert virtual machine using virt-v2v --in-place
             logging.info("Starting conversion of %s with virt-v2v", self._request["vm_name"])
+            # The disks are modified in place from now on, so the migration
+            # can't be resumed anymore
+            self._state.conversion_started = True
+            self._state.flush()
             virtv2v = destination_guestfs_helper.convert_vm(destination_vm_hardware)
             self._state.pid = virtv2v.pid
-            self._state.write()
-            virtv2v.wait()
+            self._state.flush()
+            await self._call(virtv2v.wait)
             logging.info("Conversion of %s with virt-v2v completed", self._request["vm_name"])
 
             # Detach disks from conversion host
             for destination_disk_id in destination_disks_ids:
-                destination_vm_manager.detach_disk_from_vm(self._request["conversion_host_uuid"], destination_disk_id)
+                await self._call(destination_vm_manager.detach_disk_from_vm, self._request["conversion_host_uuid"], destination_disk_id)
             destination_vm_hardware["disks"] = destination_disks_ids
 
             # Create virtual machine from the disks
             logging.debug("Destination VM Hardware: %s", destination_vm_hardware, destination_vm_operating_systems)
-            destination_vm_id = destination_vm_manager.create_vm(destination_vm_hardware)
+            destination_vm_id = await self._call(destination_vm_manager.create_vm, destination_vm_hardware)
             self._state.vm_id = destination_vm_id
 
             # Finalize
@@ -197,7 +378,33 @@ class ConversionHostRunner:
             raise err
 
         finally:
-            self._state.write()
+            for task in background_tasks:
+                task.cancel()
+            await asyncio.gather(*background_tasks, return_exceptions=True)
+            # Don't leave the inspection snapshot, or the one of a failed
+            # sync, on the source VM. VDDK must not hold its disks open.
+            if source_vm_manager is not None:
+                try:
+                    if source_guestfs_helper is not None:
+                        await self._call(source_guestfs_helper.nbd_close_connections)
+                    await self._call(source_vm_manager.release_snapshot)
+                except Exception as err:
+                    logging.error("Can't remove the snapshots of the source VM: %s", err)
+            # Sessions go back to the pool now, instead of whenever the
+            # managers are garbage collected
+            for side, vm_manager in zip(["source", "destination"], vm_managers):
+                if isinstance(vm_manager, Exception):
+                    continue
+                try:
+                    vm_manager.close()
+                except Exception as err:
+                    logging.error("Can't close the %s VmManager: %s", side, err)
+            limits_watcher.stop()
+            self._state.flush()
+            self._state.close()
+            if self._log_handler is not None:
+                logging.getLogger().removeHandler(self._log_handler)
+                self._log_handler.close()
 
 
 def main():
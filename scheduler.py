@@ -0,0 +1,303 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import json
+import time
+import logging
+import signal
+import argparse
+import threading
+
+from runner import ConversionHostRunner
+from request_validator import RequestValidator
+from providers.sessions import session_pool
+
+
+class MigrationScheduler:
+    """
+    Runs the migrations requested in a JSONL queue, one request per line,
+    with concurrent ConversionHostRunner instances in the same process.
+
+    A migration is only started when it stays within the concurrency limits
+    of every resource it uses: source ESXi host, source datastores,
+    destination storage domains and cluster, and conversion host. Requests
+    that are blocked don't hold back the ones after them. With a throughput
+    limit, migrations are also only started while the aggregate throughput
+    of the running ones leaves room for another one.
+
+    Once stopped, no migration is started anymore and the running ones are
+    waited for, so that they clean up after themselves.
+    """
+
+    LOG_FILE = "/var/log/conversion-host/scheduler.log"
+    LOG_LEVEL = logging.DEBUG
+    POLL_INTERVAL = 5 # 5 seconds
+    ADMISSION_DELAY = 30 # 30 seconds
+    SESSION_IDLE_TIMEOUT = 300 # 5 minutes
+    DEFAULT_LIMITS = {
+        "migrations": None,
+        "source_host": 10,
+        "datastore": 5,
+        "destination_storage": 10,
+        "destination_cluster": None,
+        "conversion_host": 10,
+        "throughput": None # bytes per second
+    }
+
+    def __init__(self, queue_path, limits=None, follow=False):
+        self._queue_path = queue_path
+        self._limits = dict(self.DEFAULT_LIMITS)
+        self._limits.update(self._validate_limits(limits or {}))
+        self._follow = follow
+        self._pending = []
+        self._running = []
+        self._usage = {}
+        self._finished = 0
+        self._failed = 0
+        self._invalid = 0
+        self._last_admission = 0
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+
+        log_dir = os.path.dirname(self.LOG_FILE)
+        if not os.path.isdir(log_dir):
+            os.makedirs(log_dir)
+        log_format = '%(asctime)s:%(levelname)s: %(message)s (%(module)s:%(lineno)d)'
+        logging.basicConfig(filename=self.LOG_FILE, format=log_format, level=self.LOG_LEVEL)
+
+        session_pool.idle_timeout = self.SESSION_IDLE_TIMEOUT
+
+
+    def _validate_limits(self, limits):
+        errors = []
+        for key, limit in limits.items():
+            if key not in self.DEFAULT_LIMITS:
+                errors.append("Unknown limit '%s'" % key)
+            elif limit is None:
+                continue
+            elif key == "throughput":
+                if not isinstance(limit, (int, float)) or isinstance(limit, bool) or limit <= 0:
+                    errors.append("Limit 'throughput' must be a positive number")
+            elif key == "migrations":
+                if not isinstance(limit, int) or isinstance(limit, bool) or limit < 1:
+                    errors.append("Limit 'migrations' must be a positive integer")
+            # A resource limit of 0 disallows the migrations using it
+            elif not isinstance(limit, int) or isinstance(limit, bool) or limit < 0:
+                errors.append("Limit '%s' must be a non-negative integer" % key)
+        if errors:
+            raise Exception("Errors in limits:\n%s" % "\n".join([" - %s" % e for e in errors]))
+        return limits
+
+
+    def _read_requests(self, queue):
+        while True:
+            position = queue.tell()
+            line = queue.readline()
+            if not line.endswith("\n"):
+                # Nothing more yet, or a line that is still being written
+                queue.seek(position)
+                return
+            if line.strip() == "":
+                continue
+            try:
+                request = json.loads(line)
+                request_errors = RequestValidator(request).validate()
+                if not request_errors:
+                    # Such a request would never be admitted
+                    request_errors = [
+                        "Limit '%s' is 0 for '%s'" % resource
+                        for resource in self._resources(request)
+                        if self._limits.get(resource[0]) == 0
+                    ]
+            except Exception as err:
+                request_errors = [str(err)]
+            if request_errors:
+                logging.error("Skipping invalid request at offset %d:\n%s", position, "\n".join([" - %s" % e for e in request_errors]))
+                self._invalid += 1
+                continue
+            logging.info("Queued migration of %s", request.get("vm_name"))
+            self._pending.append(request)
+
+
+    def _resources(self, request):
+        resources = [
+            ("conversion_host", request.get("conversion_host_uuid"))
+        ]
+        source = request.get("source", {})
+        if source.get("type") == "vmware":
+            resources.append(("source_host", source["authentication"]["host"]["hostname"]))
+        storage_mappings = request.get("mappings", {}).get("storage", {})
+        for datastore in sorted(storage_mappings):
+            resources.append(("datastore", datastore))
+        for storage in sorted(set(storage_mappings.values())):
+            resources.append(("destination_storage", storage))
+        if "cluster" in request.get("destination", {}):
+            resources.append(("destination_cluster", request["destination"]["cluster"]))
+        return resources
+
+
+    def _copied(self, migration):
+        runner = migration["runner"]
+        if runner is None:
+            return 0
+        with runner.state.lock:
+            return sum(
+                sync["copied"]
+                for disk in runner.state.disks.values()
+                for sync in disk["syncs"]
+            )
+
+
+    def _measure_throughput(self):
+        """
+        Return the aggregate throughput of the running migrations since the
+        last measure, and the number of migrations that are copying data.
+        """
+        now = time.monotonic()
+        throughput = 0
+        copying = 0
+        for migration in self._running:
+            copied = self._copied(migration)
+            if migration["sample"] is not None:
+                sample_time, sample_copied = migration["sample"]
+                if now > sample_time and copied > sample_copied:
+                    throughput += (copied - sample_copied) / (now - sample_time)
+                    copying += 1
+            migration["sample"] = (now, copied)
+        return throughput, copying
+
+
+    def _has_room(self, throughput, copying):
+        if self._limits["migrations"] is not None and len(self._running) >= self._limits["migrations"]:
+            return False
+        if self._limits["throughput"] is None or len(self._running) == 0:
+            return True
+
+        # Give the last started migration time to reach its throughput
+        if time.monotonic() - self._last_admission < self.ADMISSION_DELAY:
+            return False
+        expected = throughput / copying if copying > 0 else 0
+        return throughput + expected <= self._limits["throughput"]
+
+
+    def _fits(self, resources):
+        for resource in resources:
+            limit = self._limits.get(resource[0])
+            if limit is not None and self._usage.get(resource, 0) >= limit:
+                return False
+        return True
+
+
+    def _run_migration(self, migration):
+        vm_name = migration["request"].get("vm_name")
+        try:
+            migration["runner"] = ConversionHostRunner(migration["request"], shared_logging=True)
+            logging.info("Starting migration of %s", vm_name)
+            migration["runner"].run()
+            logging.info("Migration of %s finished", vm_name)
+        except Exception as err:
+            logging.error("Migration of %s failed: %s", vm_name, err)
+            migration["failed"] = True
+        finally:
+            self._wakeup.set()
+
+
+    def _admit(self):
+        throughput, copying = self._measure_throughput()
+        logging.debug("%d migrations running at %d B/s, %d queued", len(self._running), throughput, len(self._pending))
+
+        for request in list(self._pending):
+            if not self._has_room(throughput, copying):
+                return
+            # A VM is never migrated twice at the same time
+            if any(m["request"].get("vm_name") == request.get("vm_name") for m in self._running):
+                continue
+            resources = self._resources(request)
+            if not self._fits(resources):
+                continue
+
+            self._pending.remove(request)
+            for resource in resources:
+                self._usage[resource] = self._usage.get(resource, 0) + 1
+            migration = {
+                "request": request,
+                "resources": resources,
+                "runner": None,
+                "failed": False,
+                "sample": None
+            }
+            # Migrations aren't daemon threads, so that they are never killed
+            # halfway without cleaning up
+            migration["thread"] = threading.Thread(target=self._run_migration, args=(migration,))
+            migration["thread"].start()
+            self._running.append(migration)
+            self._last_admission = time.monotonic()
+
+
+    def _reap(self):
+        for migration in list(self._running):
+            if migration["thread"].is_alive():
+                continue
+            self._running.remove(migration)
+            for resource in migration["resources"]:
+                self._usage[resource] -= 1
+            self._finished += 1
+            if migration["failed"]:
+                self._failed += 1
+
+
+    def stop(self):
+        logging.info("Stopping, no more migrations will be started")
+        self._stopped.set()
+        self._wakeup.set()
+
+
+    def run(self):
+        logging.info("Scheduling migrations from %s with limits: %s", self._queue_path, self._limits)
+        with open(self._queue_path) as queue:
+            while not self._stopped.is_set():
+                self._wakeup.clear()
+                self._read_requests(queue)
+                self._reap()
+                self._admit()
+                session_pool.expire()
+
+                if not self._follow and len(self._pending) == 0 and len(self._running) == 0:
+                    break
+                self._wakeup.wait(self.POLL_INTERVAL)
+
+        if len(self._running) > 0:
+            logging.info("Waiting for %d running migrations", len(self._running))
+        for migration in list(self._running):
+            migration["thread"].join()
+        self._reap()
+        if len(self._pending) > 0:
+            logging.warning("%d queued migrations were not started", len(self._pending))
+
+        session_pool.close()
+        logging.info("%d migrations finished, %d failed, %d invalid requests", self._finished, self._failed, self._invalid)
+        return self._failed == 0 and self._invalid == 0 and len(self._pending) == 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the migrations of a JSONL queue concurrently")
+    parser.add_argument("queue", help="JSONL file with one migration request per line")
+    parser.add_argument("--limits", help="JSON file with the concurrency and throughput limits")
+    parser.add_argument("--follow", action="store_true", help="Keep waiting for new requests in the queue")
+    args = parser.parse_args()
+
+    limits = None
+    if args.limits is not None:
+        with open(args.limits) as f:
+            limits = json.load(f)
+
+    scheduler = MigrationScheduler(args.queue, limits, args.follow)
+    for signum in [signal.SIGINT, signal.SIGTERM]:
+        signal.signal(signum, lambda signum, frame: scheduler.stop())
+    if not scheduler.run():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
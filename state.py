@@ -1,38 +1,167 @@
+import atexit
+import fcntl
 import json
 import logging
 import tempfile
 import threading
+import time
 import os
 
 class State:
     """
     State object (which is a dict inside)
+
+    write() only marks the state as dirty and persists it at most once per
+    MIN_FLUSH_INTERVAL, so it can be called from hot loops. flush() persists
+    it right away and is meant for phase boundaries.
+
+    The migration holds an exclusive lock on a file next to the state file
+    for as long as it runs, so that it is never resumed concurrently.
     """
 
-    def __init__(self, path):
+    MIN_FLUSH_INTERVAL = 1 # 1 second
+
+    def __init__(self, path, resume=False):
         self._path = path
+        self._lock = threading.RLock()
+        self._lock_fd = self._acquire_lock(path)
+        self._dirty = False
+        self._last_flush = 0
+        self.cgroup = None
         self.finished = False
         self.failed = False
+        self.conversion_started = False
         self.disks = {}
+        self.progress = {
+            "sync_index": None,
+            "to_copy": 0,
+            "copied": 0
+        }
+        self.syncs = []
+        self.predicted_downtime = None
+        self.verification = None
         self.throttling = {
             "cpu": None,
             "network": None
         }
-        self.write()
+        if resume:
+            self._load()
+        self.flush()
+        atexit.register(self.flush_if_dirty)
+
+
+    @staticmethod
+    def _acquire_lock(path):
+        # The state file itself is replaced on every flush, so it can't be
+        # locked
+        fd = os.open("%s.lock" % path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            os.close(fd)
+            raise Exception("State file %s is in use by another migration" % path)
+        return fd
+
+
+    @staticmethod
+    def is_resumable(path):
+        """
+        Whether the state file is from an unfinished migration, interrupted
+        or failed, that got as far as creating its destination disks, but
+        not as far as converting them. A migration that is still running
+        can't be resumed.
+        """
+        try:
+            with open(path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return False
+
+        # Syncing changes onto converted disks would corrupt them
+        if state.get("conversion_started", False):
+            return False
+        try:
+            os.close(State._acquire_lock(path))
+        except Exception:
+            return False
+
+        # Failed migrations are finished too, but can carry on with the
+        # destination disks they have created
+        return (not state.get("finished", True) or state.get("failed", False)) \
+            and len(state.get("disks", {})) > 0 \
+            and all("destination" in disk for disk in state["disks"].values())
+
+
+    def _load(self):
+        logging.info("Resuming from state file: %s", self._path)
+        with open(self._path) as f:
+            state = json.load(f)
+        self.disks = state["disks"]
+        self.syncs = state.get("syncs", [])
+        self.throttling = state.get("throttling", self.throttling)
+
+
+    @property
+    def lock(self):
+        return self._lock
 
 
     def __str__(self):
-        state = {
-            "finished": self.finished,
-            "failed": self.failed,
-            "disks": self.disks,
-            "throttling": self.throttling
-        }
-        return json.dumps(state)
+        with self._lock:
+            state = {
+                "finished": self.finished,
+                "failed": self.failed,
+                "conversion_started": self.conversion_started,
+                "disks": self.disks,
+                "progress": self.progress,
+                "syncs": self.syncs,
+                "predicted_downtime": self.predicted_downtime,
+                "verification": self.verification,
+                "throttling": self.throttling
+            }
+            return json.dumps(state)
 
 
     def write(self):
-        tmp_fd, tmp_path = tempfile.mkstemp(suffix = '.v2v.state')
-        with os.fdopen(tmp_fd, 'w') as fd:
-            fd.write(str(self))
-        os.rename(tmp_path, self._path)
+        with self._lock:
+            self._dirty = True
+            if time.monotonic() - self._last_flush >= self.MIN_FLUSH_INTERVAL:
+                self.flush()
+
+
+    def flush_if_dirty(self):
+        with self._lock:
+            if self._dirty:
+                self.flush()
+
+
+    def close(self):
+        """
+        Persist the last writes and stop tracking the state at exit, so that
+        a long-running process doesn't keep every migration's state alive.
+        """
+        atexit.unregister(self.flush_if_dirty)
+        self.flush_if_dirty()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+
+    def flush(self):
+        with self._lock:
+            # The temporary file is created next to the state file, so that
+            # the rename is atomic.
+            tmp_fd, tmp_path = tempfile.mkstemp(
+                dir = os.path.dirname(self._path),
+                prefix = ".%s." % os.path.basename(self._path),
+                suffix = '.tmp'
+            )
+            try:
+                with os.fdopen(tmp_fd, 'w') as fd:
+                    fd.write(str(self))
+                os.replace(tmp_path, self._path)
+            except:
+                os.unlink(tmp_path)
+                raise
+            self._dirty = False
+            self._last_flush = time.monotonic()
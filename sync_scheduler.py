@@ -0,0 +1,83 @@
+import logging
+import time
+
+
+class SyncScheduler:
+    """
+    Picks the interval between warm syncs so that the amount of data changed
+    between two syncs converges towards a target size, and predicts how long
+    the final sync would take if cutover was requested now.
+    """
+
+    SMOOTHING = 0.5
+
+    def __init__(self, state, target_delta, default_interval, min_interval, max_interval):
+        self._state = state
+        self._target_delta = target_delta
+        self._default_interval = default_interval
+        self._min_interval = min_interval
+        self._max_interval = max_interval
+        self._dirty_rate = None
+        self._throughput = None
+        self._last_start = None
+        self._sync_start = None
+        self.interval = default_interval
+
+
+    def _smooth(self, previous, value):
+        if previous is None:
+            return value
+        return self.SMOOTHING * value + (1 - self.SMOOTHING) * previous
+
+
+    def start(self):
+        self._sync_start = time.monotonic()
+
+
+    def record(self, sync_index, changed):
+        now = time.monotonic()
+        duration = now - self._sync_start
+        sync = {
+            "index": sync_index,
+            "changed": changed,
+            "duration": round(duration, 3)
+        }
+
+        if duration > 0 and changed > 0:
+            self._throughput = self._smooth(self._throughput, changed / duration)
+            sync["throughput"] = int(changed / duration)
+
+        # The first sync copies the whole disks, so it says nothing about how
+        # fast data changes. Later ones copy what changed since the previous
+        # snapshot, which was taken when the previous sync started.
+        if self._last_start is not None:
+            dirty_rate = changed / (self._sync_start - self._last_start)
+            self._dirty_rate = self._smooth(self._dirty_rate, dirty_rate)
+            sync["dirty_rate"] = int(dirty_rate)
+        self._last_start = self._sync_start
+
+        if self._dirty_rate is None:
+            self.interval = self._default_interval
+        elif self._dirty_rate == 0:
+            self.interval = self._max_interval
+        else:
+            # Data changed since the next snapshot is dirty_rate * (duration + interval)
+            interval = self._target_delta / self._dirty_rate - duration
+            self.interval = max(self._min_interval, min(self._max_interval, interval))
+
+        with self._state.lock:
+            sync["next_interval"] = round(self.interval, 3)
+            self._state.syncs.append(sync)
+            self._state.predicted_downtime = self.predicted_downtime(duration)
+        self._state.flush()
+
+        logging.info("Sync %d changed %d B in %.1f s, next sync in %.1f s", sync_index, changed, duration, self.interval)
+
+
+    def predicted_downtime(self, duration):
+        """
+        Duration of the final sync if cutover happens at the next sync.
+        """
+        if self._dirty_rate is None or not self._throughput:
+            return None
+        return round(self._dirty_rate * (duration + self.interval) / self._throughput, 3)
@@ -0,0 +1,35 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakeClock:
+    """
+    Stands for the time module of the code under test. Time only moves when
+    advanced, or slept.
+    """
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = []
+
+
+    def monotonic(self):
+        return self.now
+
+
+    def sleep(self, delay):
+        self.slept.append(delay)
+        self.now += delay
+
+
+    def advance(self, delay):
+        self.now += delay
+
+
+@pytest.fixture
+def clock():
+    return FakeClock()
@@ -0,0 +1,113 @@
+from providers.vmware.extents import (
+    AllocationMap, Extent, add_range, clip_extents, coalesce_extents, merge_blocks, split_blocks, subtract_ranges
+)
+
+
+def _block(offset, length, flags=0):
+    return {"offset": offset, "length": length, "flags": flags}
+
+
+def test_coalesce_extents_merges_overlapping_and_touching():
+    extents = [Extent(100, 50), Extent(0, 10), Extent(10, 20), Extent(120, 10)]
+    assert coalesce_extents(extents) == [Extent(0, 30), Extent(100, 50)]
+
+
+def test_coalesce_extents_bridges_small_gaps():
+    extents = [Extent(0, 10), Extent(15, 5), Extent(40, 10)]
+    assert coalesce_extents(extents, gap=5) == [Extent(0, 20), Extent(40, 10)]
+    assert coalesce_extents(extents, gap=4) == extents
+
+
+def test_coalesce_extents_keeps_contained_extent():
+    assert coalesce_extents([Extent(0, 100), Extent(10, 10)]) == [Extent(0, 100)]
+    assert coalesce_extents([]) == []
+
+
+def test_merge_blocks_merges_contiguous_blocks_with_same_flags():
+    blocks = [_block(8, 8, 1), _block(0, 8, 1), _block(16, 8, 3), _block(32, 8, 3)]
+    assert merge_blocks(blocks, 1) == [_block(0, 24, 1), _block(32, 8, 3)]
+    # Flags outside the mask don't matter, the first block's are kept
+    assert merge_blocks(blocks, 2) == [_block(0, 16, 1), _block(16, 8, 3), _block(32, 8, 3)]
+
+
+def test_merge_blocks_leaves_input_untouched():
+    blocks = [_block(0, 8), _block(8, 8)]
+    merge_blocks(blocks, 1)
+    assert blocks == [_block(0, 8), _block(8, 8)]
+
+
+def test_split_blocks_cuts_blocks_at_stripe_boundaries():
+    stripes = split_blocks([_block(0, 10, 1), _block(20, 20, 2)], 3)
+    assert stripes == [
+        [_block(0, 10, 1)],
+        [_block(20, 10, 2)],
+        [_block(30, 10, 2)]
+    ]
+
+
+def test_split_blocks_with_fewer_bytes_than_stripes():
+    assert split_blocks([_block(0, 2)], 4) == [[_block(0, 1)], [_block(1, 1)]]
+
+
+def test_split_blocks_rounds_stripe_length_up():
+    stripes = split_blocks([_block(0, 10)], 3)
+    assert [sum(b["length"] for b in stripe) for stripe in stripes] == [4, 4, 2]
+
+
+def test_add_range_merges_overlapping_and_touching_ranges():
+    ranges = []
+    add_range(ranges, 10, 10)
+    add_range(ranges, 40, 10)
+    add_range(ranges, 0, 5)
+    assert ranges == [[0, 5], [10, 10], [40, 10]]
+    add_range(ranges, 20, 5)
+    assert ranges == [[0, 5], [10, 15], [40, 10]]
+    add_range(ranges, 3, 40)
+    assert ranges == [[0, 50]]
+
+
+def test_subtract_ranges():
+    ranges = [[10, 10], [30, 10]]
+    assert subtract_ranges([Extent(0, 50)], ranges) == [Extent(0, 10), Extent(20, 10), Extent(40, 10)]
+    assert subtract_ranges([Extent(12, 5), Extent(35, 10)], ranges) == [Extent(40, 5)]
+    assert subtract_ranges([Extent(0, 10)], ranges) == [Extent(0, 10)]
+    assert subtract_ranges([Extent(0, 10)], []) == [Extent(0, 10)]
+
+
+def test_clip_extents():
+    extents = [Extent(0, 10), Extent(20, 10), Extent(40, 10)]
+    assert clip_extents(extents, 5, 25) == [Extent(5, 5), Extent(20, 5)]
+    assert clip_extents(extents, 10, 20) == []
+
+
+def test_allocation_map_tracks_missing_ranges(tmp_path):
+    allocation_map = AllocationMap(str(tmp_path / "disk.map"))
+    assert allocation_map.missing(0, 100) == [(0, 100)]
+
+    allocation_map.update([_block(0, 20, 1), _block(50, 10, 2)])
+    assert allocation_map.missing(0, 100) == [(20, 30), (60, 40)]
+    assert allocation_map.blocks(10, 45) == [_block(10, 10, 1), _block(50, 5, 2)]
+
+
+def test_allocation_map_invalidate_splits_blocks(tmp_path):
+    allocation_map = AllocationMap(str(tmp_path / "disk.map"))
+    allocation_map.update([_block(0, 100, 1)])
+    allocation_map.invalidate(40, 20)
+    assert allocation_map.missing(0, 100) == [(40, 20)]
+    assert allocation_map.blocks(0, 100) == [_block(0, 40, 1), _block(60, 40, 1)]
+
+    # Updated blocks replace the ones they overlap
+    allocation_map.update([_block(30, 40, 2)])
+    assert allocation_map.blocks(0, 100) == [_block(0, 30, 1), _block(30, 40, 2), _block(70, 30, 1)]
+
+
+def test_allocation_map_is_saved_and_loaded(tmp_path):
+    path = str(tmp_path / "disk.map")
+    allocation_map = AllocationMap(path)
+    allocation_map.update([_block(0, 20, 1), _block(50, 10, 2)])
+    allocation_map.save()
+
+    loaded = AllocationMap(path)
+    assert loaded.blocks(0, 100) == [_block(0, 20, 1), _block(50, 10, 2)]
+    assert loaded.missing(0, 100) == [(20, 30), (60, 40)]
+    assert [p.name for p in tmp_path.iterdir()] == ["disk.map"]
@@ -0,0 +1,71 @@
+from types import SimpleNamespace
+
+import pytest
+
+from providers.vmware import moref_cache
+from providers.vmware.moref_cache import MorefCache
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(moref_cache, "time", clock)
+
+
+def test_lookups_are_cached_until_expiry(clock):
+    cache = MorefCache(60)
+    lookups = []
+
+    def lookup():
+        lookups.append(1)
+        return "vm-%d" % len(lookups)
+
+    assert cache.get("vm", "uuid1", lookup) == "vm-1"
+    clock.advance(59)
+    assert cache.get("vm", "uuid1", lookup) == "vm-1"
+    clock.advance(1)
+    assert cache.get("vm", "uuid1", lookup) == "vm-2"
+    assert cache.stats() == {"vm": {"hits": 1, "misses": 2}}
+
+
+def test_miss_without_lookup():
+    cache = MorefCache(60)
+    assert cache.get("vm", "uuid1") is None
+    cache.put("vm", "uuid1", "vm-1")
+    assert cache.get("vm", "uuid1") == "vm-1"
+
+
+def test_invalidate_by_kind_and_key():
+    cache = MorefCache(60)
+    cache.put("vm", "uuid1", "vm-1")
+    cache.put("vm", "uuid2", "vm-2")
+    cache.put("host", "host-1", "esx1")
+
+    cache.invalidate("vm", "uuid1")
+    assert cache.get("vm", "uuid1") is None
+    assert cache.get("vm", "uuid2") == "vm-2"
+
+    cache.invalidate("vm")
+    assert cache.get("vm", "uuid2") is None
+    assert cache.get("host", "host-1") == "esx1"
+
+    cache.invalidate()
+    assert cache.get("host", "host-1") is None
+
+
+def test_invalidate_object_drops_entries_holding_it():
+    cache = MorefCache(60)
+    vm = SimpleNamespace(_moId="vm-1")
+    datastore = SimpleNamespace(_moId="datastore-1")
+    cache.put("vm", "uuid1", vm)
+    cache.put("properties", "vm-1", {"name": "vm1"})
+    cache.put("datastores", "vm-2", [{"moref": "datastore-1"}, {"moref": "datastore-2"}])
+    cache.put("datastore", "ds1", datastore)
+
+    cache.invalidate_object(vm)
+    assert cache.get("vm", "uuid1") is None
+    assert cache.get("properties", "vm-1") is None
+    assert cache.get("datastore", "ds1") is datastore
+
+    cache.invalidate_object(datastore)
+    assert cache.get("datastores", "vm-2") is None
+    assert cache.get("datastore", "ds1") is None
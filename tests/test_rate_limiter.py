@@ -0,0 +1,53 @@
+import pytest
+
+from providers.vmware import rate_limiter
+from providers.vmware.rate_limiter import RateLimiter
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(rate_limiter, "time", clock)
+
+
+def test_no_rate_means_no_limit(clock):
+    limiter = RateLimiter(lambda: None)
+    for _ in range(10):
+        limiter.consume(1 << 30)
+    assert clock.slept == []
+
+
+def test_consume_waits_for_tokens(clock):
+    limiter = RateLimiter(lambda: 1000)
+    limiter.consume(500)
+    limiter.consume(500)
+    assert clock.slept == [0.5, 0.5]
+
+
+def test_bursts_are_capped_to_one_second(clock):
+    limiter = RateLimiter(lambda: 1000)
+    clock.advance(10)
+    limiter.consume(1000)
+    assert clock.slept == []
+    limiter.consume(1000)
+    assert clock.slept == [1]
+
+
+def test_large_requests_are_paid_back(clock):
+    limiter = RateLimiter(lambda: 1000)
+    clock.advance(1)
+    # Going through with one second of tokens, the rest is owed
+    limiter.consume(3000)
+    assert clock.slept == []
+    limiter.consume(1000)
+    assert clock.slept == [3]
+
+
+def test_rate_is_read_on_every_call(clock):
+    rate = [1000]
+    limiter = RateLimiter(lambda: rate[0])
+    limiter.consume(500)
+    rate[0] = 250
+    limiter.consume(250)
+    rate[0] = None
+    limiter.consume(1 << 30)
+    assert clock.slept == [0.5, 1]
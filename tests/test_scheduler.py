@@ -0,0 +1,138 @@
+import json
+import threading
+
+import pytest
+
+import scheduler as scheduler_module
+from scheduler import MigrationScheduler
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock, tmp_path):
+    monkeypatch.setattr(scheduler_module, "time", clock)
+    monkeypatch.setattr(MigrationScheduler, "LOG_FILE", str(tmp_path / "log" / "scheduler.log"))
+
+
+@pytest.fixture
+def queue_path(tmp_path):
+    path = tmp_path / "queue.jsonl"
+    path.write_text("")
+    return str(path)
+
+
+def _request(vm_name, host="esx1", datastore="ds1", storage="sd1"):
+    return {
+        "conversion_host_uuid": "ch1",
+        "vm_name": vm_name,
+        "vm_uuid": "uuid-%s" % vm_name,
+        "source": {
+            "type": "vmware",
+            "transport_method": "vddk",
+            "authentication": {
+                "manager": {"hostname": "vcenter"},
+                "host": {"hostname": host}
+            }
+        },
+        "destination": {
+            "type": "ovirt",
+            "transport_method": "upload_api",
+            "authentication": {"manager": {"hostname": "engine"}},
+            "cluster": "cluster1",
+            "storage": storage
+        },
+        "mappings": {"storage": {datastore: storage}, "network": {}}
+    }
+
+
+@pytest.fixture
+def blocked_migrations(monkeypatch):
+    # Migrations run until released
+    release = threading.Event()
+    monkeypatch.setattr(MigrationScheduler, "_run_migration", lambda self, migration: release.wait(10))
+    yield
+    release.set()
+
+
+@pytest.mark.parametrize("limits, error", [
+    ({"hosts": 1}, "Unknown limit 'hosts'"),
+    ({"throughput": 0}, "Limit 'throughput' must be a positive number"),
+    ({"migrations": 0}, "Limit 'migrations' must be a positive integer"),
+    ({"datastore": -1}, "Limit 'datastore' must be a non-negative integer"),
+    ({"source_host": True}, "Limit 'source_host' must be a non-negative integer"),
+    ({"source_host": 1.5}, "Limit 'source_host' must be a non-negative integer")
+])
+def test_invalid_limits(queue_path, limits, error):
+    with pytest.raises(Exception, match=error):
+        MigrationScheduler(queue_path, limits)
+
+
+def test_valid_limits(queue_path):
+    scheduler = MigrationScheduler(queue_path, {"datastore": 0, "source_host": None, "throughput": 1.5e8})
+    assert scheduler._limits["datastore"] == 0
+    assert scheduler._limits["source_host"] is None
+    assert scheduler._limits["conversion_host"] == MigrationScheduler.DEFAULT_LIMITS["conversion_host"]
+
+
+def test_requests_over_a_zero_limit_are_rejected(queue_path):
+    scheduler = MigrationScheduler(queue_path, {"datastore": 0})
+    with open(queue_path, "w") as f:
+        f.write(json.dumps(_request("vm1")) + "\n")
+        f.write("not json\n")
+        f.write(json.dumps({"vm_name": "vm2"}) + "\n")
+    with open(queue_path) as queue:
+        scheduler._read_requests(queue)
+    assert scheduler._pending == []
+    assert scheduler._invalid == 3
+
+
+def test_partial_lines_are_read_once_complete(queue_path):
+    scheduler = MigrationScheduler(queue_path)
+    line = json.dumps(_request("vm1"))
+    with open(queue_path, "w") as f:
+        f.write(line[:10])
+    with open(queue_path) as queue:
+        scheduler._read_requests(queue)
+        assert scheduler._pending == []
+        with open(queue_path, "a") as f:
+            f.write(line[10:] + "\n")
+        scheduler._read_requests(queue)
+    assert [r["vm_name"] for r in scheduler._pending] == ["vm1"]
+
+
+def test_fits_resource_limits(queue_path):
+    scheduler = MigrationScheduler(queue_path, {"datastore": 2})
+    resources = scheduler._resources(_request("vm1"))
+    assert ("datastore", "ds1") in resources
+    assert ("source_host", "esx1") in resources
+    assert scheduler._fits(resources)
+    scheduler._usage[("datastore", "ds1")] = 2
+    assert not scheduler._fits(resources)
+    assert scheduler._fits(scheduler._resources(_request("vm2", datastore="ds2")))
+
+
+def test_has_room_for_migrations_limit(queue_path):
+    scheduler = MigrationScheduler(queue_path, {"migrations": 1})
+    assert scheduler._has_room(0, 0)
+    scheduler._running.append({})
+    assert not scheduler._has_room(0, 0)
+
+
+def test_has_room_for_throughput_limit(queue_path, clock):
+    scheduler = MigrationScheduler(queue_path, {"throughput": 300})
+    scheduler._running.append({})
+    scheduler._last_admission = clock.monotonic()
+    # The last started migration hasn't reached its throughput yet
+    assert not scheduler._has_room(0, 0)
+    clock.advance(MigrationScheduler.ADMISSION_DELAY)
+    assert scheduler._has_room(200, 2)
+    assert not scheduler._has_room(250, 2)
+
+
+def test_blocked_requests_dont_hold_back_others(queue_path, blocked_migrations):
+    scheduler = MigrationScheduler(queue_path, {"source_host": 1})
+    scheduler._pending = [_request("vm1"), _request("vm2"), _request("vm3", host="esx2"), _request("vm1", host="esx3")]
+    scheduler._admit()
+    assert [m["request"]["vm_name"] for m in scheduler._running] == ["vm1", "vm3"]
+    # vm1 isn't migrated twice at once
+    assert [r["vm_name"] for r in scheduler._pending] == ["vm2", "vm1"]
+    assert scheduler._usage[("source_host", "esx1")] == 1
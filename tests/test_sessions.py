@@ -0,0 +1,108 @@
+import pytest
+
+from providers import sessions
+from providers.sessions import SessionPool
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(sessions, "time", clock)
+
+
+class FakeEndpoint:
+
+    def __init__(self):
+        self.opened = 0
+        self.closed = []
+
+
+    def connect(self):
+        self.opened += 1
+        return "session%d" % self.opened
+
+
+    def disconnect(self, connection):
+        self.closed.append(connection)
+
+
+def test_sessions_are_shared_and_closed_when_unused():
+    endpoint = FakeEndpoint()
+    pool = SessionPool()
+    key = ("vmware", "esx1", "user")
+    assert pool.acquire(key, endpoint.connect, endpoint.disconnect) == "session1"
+    assert pool.acquire(key, endpoint.connect, endpoint.disconnect) == "session1"
+    assert endpoint.opened == 1
+
+    pool.release(key)
+    assert endpoint.closed == []
+    pool.release(key)
+    assert endpoint.closed == ["session1"]
+
+    # The next user gets a new session
+    assert pool.acquire(key, endpoint.connect, endpoint.disconnect) == "session2"
+
+
+def test_sessions_are_keyed_by_endpoint():
+    endpoint = FakeEndpoint()
+    pool = SessionPool()
+    assert pool.acquire(("vmware", "esx1", "user"), endpoint.connect) == "session1"
+    assert pool.acquire(("vmware", "esx2", "user"), endpoint.connect) == "session2"
+
+
+def test_idle_sessions_are_kept_until_timeout(clock):
+    endpoint = FakeEndpoint()
+    pool = SessionPool(idle_timeout=300)
+    key = ("ovirt", "engine", "admin")
+    pool.acquire(key, endpoint.connect, endpoint.disconnect)
+    pool.release(key)
+
+    clock.advance(200)
+    pool.expire()
+    assert pool.acquire(key, endpoint.connect, endpoint.disconnect) == "session1"
+    pool.release(key)
+
+    clock.advance(299)
+    pool.expire()
+    assert endpoint.closed == []
+    clock.advance(1)
+    pool.expire()
+    assert endpoint.closed == ["session1"]
+
+
+def test_close_leaves_referenced_sessions():
+    endpoint = FakeEndpoint()
+    pool = SessionPool(idle_timeout=300)
+    pool.acquire(("ovirt", "engine1", "admin"), endpoint.connect, endpoint.disconnect)
+    pool.acquire(("ovirt", "engine2", "admin"), endpoint.connect, endpoint.disconnect)
+    pool.release(("ovirt", "engine2", "admin"))
+    pool.close()
+    assert endpoint.closed == ["session2"]
+
+
+def test_concurrent_connection_is_dropped():
+    endpoint = FakeEndpoint()
+    pool = SessionPool()
+    key = ("vmware", "esx1", "user")
+
+    def connect():
+        # Another migration connects while this one is connecting
+        pool.acquire(key, endpoint.connect, endpoint.disconnect)
+        return "late"
+
+    assert pool.acquire(key, connect, endpoint.disconnect) == "session1"
+    assert endpoint.closed == ["late"]
+    pool.release(key)
+    pool.release(key)
+    assert endpoint.closed == ["late", "session1"]
+
+
+def test_failed_disconnect_is_logged(caplog):
+    def disconnect(connection):
+        raise OSError("connection reset")
+
+    pool = SessionPool()
+    pool.acquire(("vmware", "esx1", "user"), lambda: "session", disconnect)
+    pool.release(("vmware", "esx1", "user"))
+    assert "connection reset" in caplog.text
+    # The session is gone all the same
+    assert pool.acquire(("vmware", "esx1", "user"), lambda: "new session") == "new session"
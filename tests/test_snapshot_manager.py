@@ -0,0 +1,95 @@
+import threading
+
+import pytest
+
+pytest.importorskip("pyVmomi")
+
+from pyVmomi import vim
+
+from providers.vmware import snapshot_manager
+from providers.vmware.snapshot_manager import SnapshotManager
+
+
+class FakeVm:
+    """
+    Runs one snapshot task at a time, like vSphere does for a VM, and
+    rejects the ones that overlap with TaskInProgress.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.busy = False
+        self.removal_started = threading.Event()
+        self.finish_removal = threading.Event()
+        self.snapshots = []
+        self.rejected = 0
+
+
+    def create_snapshot(self, vm_id, name):
+        with self.lock:
+            if self.busy:
+                self.rejected += 1
+                raise vim.fault.TaskInProgress()
+            snapshot = FakeSnapshot(self, name)
+            self.snapshots.append(snapshot)
+            return snapshot
+
+
+class FakeSnapshot:
+
+    def __init__(self, vm, name):
+        self._vm = vm
+        self._moId = name
+
+
+    def RemoveSnapshot_Task(self, remove_children):
+        with self._vm.lock:
+            if self._vm.busy:
+                raise vim.fault.TaskInProgress()
+            self._vm.busy = True
+        self._vm.removal_started.set()
+        self._vm.finish_removal.wait(5)
+        with self._vm.lock:
+            self._vm.snapshots.remove(self)
+            self._vm.busy = False
+
+
+@pytest.fixture(autouse=True)
+def wait_for_task(monkeypatch):
+    # The fake removal task is done by the time it returns
+    monkeypatch.setattr(snapshot_manager, "WaitForTask", lambda task: task)
+
+
+def test_take_waits_for_running_removal():
+    vm = FakeVm()
+    snapshots = SnapshotManager(vm, 2)
+    first = snapshots.take("vm", "first")
+    snapshots.release(first)
+    vm.removal_started.wait(5)
+
+    # The removal finishes once the creation has been rejected
+    threading.Timer(0.1, vm.finish_removal.set).start()
+    second = snapshots.take("vm", "second")
+
+    assert vm.rejected >= 1
+    assert vm.snapshots == [second]
+    snapshots.release(second)
+    snapshots.release_all()
+    assert vm.snapshots == []
+
+
+def test_take_raises_task_in_progress_without_removals():
+    vm = FakeVm()
+    vm.busy = True
+    snapshots = SnapshotManager(vm, 2)
+    with pytest.raises(vim.fault.TaskInProgress):
+        snapshots.take("vm", "first")
+
+
+def test_take_reuses_adopted_snapshot():
+    vm = FakeVm()
+    snapshots = SnapshotManager(vm, 2)
+    inspection = vm.create_snapshot("vm", "inspection")
+    snapshots.adopt(inspection)
+    assert snapshots.take("vm", "sync") is inspection
+    assert vm.snapshots == [inspection]
@@ -0,0 +1,103 @@
+import json
+
+import pytest
+
+import state as state_module
+from state import State
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "migration.state")
+
+
+def _read(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save(path, **values):
+    state = State(path)
+    for key, value in values.items():
+        setattr(state, key, value)
+    state.flush()
+    state.close()
+
+
+def test_write_is_throttled(monkeypatch, clock, path):
+    monkeypatch.setattr(state_module, "time", clock)
+    state = State(path)
+    state.progress["copied"] = 1
+    state.write()
+    assert _read(path)["progress"]["copied"] == 0
+
+    clock.advance(State.MIN_FLUSH_INTERVAL)
+    state.progress["copied"] = 2
+    state.write()
+    assert _read(path)["progress"]["copied"] == 2
+
+    state.progress["copied"] = 3
+    state.write()
+    state.flush_if_dirty()
+    assert _read(path)["progress"]["copied"] == 3
+    state.close()
+
+
+def test_close_persists_last_writes(tmp_path, path):
+    state = State(path)
+    state.progress["copied"] = 1
+    state.write()
+    state.close()
+    assert _read(path)["progress"]["copied"] == 1
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["migration.state", "migration.state.lock"]
+
+
+def test_state_is_locked_while_open(path):
+    state = State(path)
+    with pytest.raises(Exception, match="in use by another migration"):
+        State(path, resume=True)
+    state.close()
+    State(path, resume=True).close()
+
+
+def test_resume_loads_disks_and_syncs(path):
+    _save(path, failed=True, finished=True, disks={"disk1": {"destination": {"id": "d1"}}}, syncs=[{"index": 0}])
+    state = State(path, resume=True)
+    assert state.disks == {"disk1": {"destination": {"id": "d1"}}}
+    assert state.syncs == [{"index": 0}]
+    # The resumed migration starts afresh
+    assert not state.failed
+    state.close()
+
+
+DISKS = {"disk1": {"destination": {"id": "d1"}}}
+
+
+@pytest.mark.parametrize("values, resumable", [
+    ({"finished": False, "disks": DISKS}, True),
+    ({"finished": True, "failed": True, "disks": DISKS}, True),
+    ({"finished": True, "disks": DISKS}, False),
+    ({"finished": True, "failed": True, "conversion_started": True, "disks": DISKS}, False),
+    ({"finished": False, "disks": {}}, False),
+    ({"finished": True, "failed": True, "disks": {"disk1": {}}}, False)
+])
+def test_is_resumable(path, values, resumable):
+    _save(path, **values)
+    assert State.is_resumable(path) == resumable
+
+
+def test_running_migration_is_not_resumable(path):
+    state = State(path)
+    state.disks = DISKS
+    state.failed = True
+    state.flush()
+    assert not State.is_resumable(path)
+    state.close()
+    assert State.is_resumable(path)
+
+
+def test_missing_or_corrupt_state_is_not_resumable(path):
+    assert not State.is_resumable(path)
+    with open(path, "w") as f:
+        f.write("{")
+    assert not State.is_resumable(path)
@@ -0,0 +1,63 @@
+import pytest
+
+import sync_scheduler
+from state import State
+from sync_scheduler import SyncScheduler
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(sync_scheduler, "time", clock)
+
+
+@pytest.fixture
+def state(tmp_path):
+    state = State(str(tmp_path / "migration.state"))
+    yield state
+    state.close()
+
+
+def _sync(scheduler, clock, sync_index, changed, duration, wait=0):
+    clock.advance(wait)
+    scheduler.start()
+    clock.advance(duration)
+    scheduler.record(sync_index, changed)
+
+
+def test_first_sync_uses_default_interval(state, clock):
+    scheduler = SyncScheduler(state, 1000, 60, 10, 900)
+    _sync(scheduler, clock, 0, 10000, 10)
+    assert scheduler.interval == 60
+    assert state.syncs == [{"index": 0, "changed": 10000, "duration": 10, "throughput": 1000, "next_interval": 60}]
+    assert state.predicted_downtime is None
+
+
+def test_interval_targets_delta(state, clock):
+    scheduler = SyncScheduler(state, 1000, 60, 10, 900)
+    _sync(scheduler, clock, 0, 10000, 10)
+    # 700 B changed in the 70 s since the first snapshot
+    _sync(scheduler, clock, 1, 700, 2, wait=60)
+    assert state.syncs[1]["dirty_rate"] == 10
+    assert scheduler.interval == pytest.approx(1000 / 10 - 2)
+    # Throughput is smoothed over both syncs
+    assert state.predicted_downtime == pytest.approx(10 * 100 / (0.5 * 350 + 0.5 * 1000), abs=0.001)
+
+
+def test_interval_is_clamped(state, clock):
+    scheduler = SyncScheduler(state, 1000, 60, 10, 900)
+    _sync(scheduler, clock, 0, 10000, 10)
+    _sync(scheduler, clock, 1, 100000, 2, wait=60)
+    assert scheduler.interval == 10
+
+    scheduler = SyncScheduler(state, 1000, 60, 10, 900)
+    _sync(scheduler, clock, 0, 10000, 10)
+    _sync(scheduler, clock, 1, 1, 2, wait=60)
+    assert scheduler.interval == 900
+
+
+def test_unchanged_disks_use_max_interval(state, clock):
+    scheduler = SyncScheduler(state, 1000, 60, 10, 900)
+    _sync(scheduler, clock, 0, 10000, 10)
+    _sync(scheduler, clock, 1, 0, 1, wait=60)
+    assert scheduler.interval == 900
+    assert state.predicted_downtime == 0
@@ -0,0 +1,69 @@
+import pytest
+
+from providers.vmware import transfer_tuner
+from providers.vmware.transfer_tuner import TransferTuner
+
+
+@pytest.fixture(autouse=True)
+def fake_time(monkeypatch, clock):
+    monkeypatch.setattr(transfer_tuner, "time", clock)
+
+
+def _window(tuner, clock, throughput):
+    # A single request that takes the whole window
+    clock.advance(TransferTuner.WINDOW_DURATION)
+    tuner.record(int(throughput * TransferTuner.WINDOW_DURATION), 0.01)
+
+
+def test_tuner_keeps_best_settings(clock):
+    tuner = TransferTuner(4096, 16384, 1, 8)
+
+    def throughput():
+        # Gains stop past 4 requests in flight and 8 KiB reads
+        return min(tuner.aio_in_flight, 4) * min(tuner.pread_len, 8192)
+
+    settings = []
+    for _ in range(8):
+        _window(tuner, clock, throughput())
+        settings.append((tuner.aio_in_flight, tuner.pread_len))
+
+    assert settings == [
+        (2, 4096),
+        (4, 4096),
+        (8, 4096),
+        (4, 8192),
+        (4, 16384),
+        (4, 8192),
+        (4, 8192),
+        (4, 8192)
+    ]
+    assert tuner.summary()["throughput"] == 4 * 8192
+
+
+def test_tuner_clamps_initial_settings():
+    tuner = TransferTuner(65536, 16384, 16, 8)
+    assert (tuner.aio_in_flight, tuner.pread_len) == (8, 16384)
+
+
+def test_disabled_tuner_keeps_settings(clock):
+    tuner = TransferTuner(4096, 16384, 1, 8, enabled=False)
+    for throughput in [100, 200, 400]:
+        _window(tuner, clock, throughput)
+    assert (tuner.aio_in_flight, tuner.pread_len) == (1, 4096)
+    assert tuner.throughput == 400
+
+
+def test_tuner_ignores_small_gains(clock):
+    tuner = TransferTuner(4096, 16384, 1, 8)
+    _window(tuner, clock, 1000)
+    assert tuner.aio_in_flight == 2
+    # Less than MIN_GAIN better, so the previous setting is kept
+    _window(tuner, clock, 1040)
+    assert (tuner.aio_in_flight, tuner.pread_len) == (1, 8192)
+
+
+def test_summary_before_first_window(clock):
+    tuner = TransferTuner(4096, 16384, 1, 8)
+    clock.advance(1)
+    tuner.record(1000, 0.5)
+    assert tuner.summary() == {"aio_in_flight": 1, "pread_len": 4096, "throughput": 1000, "latency": 0}
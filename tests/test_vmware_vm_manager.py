@@ -0,0 +1,83 @@
+import ctypes
+import errno
+import os
+import time
+
+import pytest
+
+pytest.importorskip("nbd")
+pytest.importorskip("pyVmomi")
+
+from state import State
+from providers.vmware.disk_io import BufferPool
+from providers.vmware.transfer_tuner import TransferTuner
+from providers.vmware.vm_manager import VmManager
+
+
+@pytest.fixture
+def stream(tmp_path):
+    vm_manager = VmManager.__new__(VmManager)
+    vm_manager._request = {"source": {}}
+    vm_manager._state = State(str(tmp_path / "migration.state"))
+
+    path = str(tmp_path / "disk")
+    fd = os.open(path, os.O_RDWR | os.O_CREAT)
+    stream = {
+        "vm_manager": vm_manager,
+        "path": path,
+        "destination": {
+            "fd": fd,
+            "direct_fd": None,
+            "flush_interval": VmManager.FLUSH_INTERVAL,
+            "unflushed": 0,
+            "written": [],
+            "completed": []
+        },
+        "tuner": TransferTuner(4096, 4096, 1, 1),
+        "sync": {"to_copy": 0, "copied": 0, "skipped": 0},
+        "read_errors": [],
+        "write_errors": [],
+        "buffer_pool": BufferPool(1, 4096),
+        "compare_pool": None
+    }
+    yield stream
+    stream["buffer_pool"].close()
+    os.close(stream["destination"]["fd"])
+
+
+def _complete_read(stream, data, err):
+    # What an aio_pread completion callback gets from libnbd
+    buf, view = stream["buffer_pool"].acquire(len(data))
+    view[:] = data
+    return stream["vm_manager"]._write_data(stream, buf, view, 0, time.monotonic(), ctypes.c_int(err))
+
+
+def test_write_data_writes_successful_read(stream):
+    assert _complete_read(stream, b"x" * 4096, 0) == 1
+    with open(stream["path"], "rb") as f:
+        assert f.read() == b"x" * 4096
+    assert stream["destination"]["written"] == [[0, 4096]]
+    assert stream["read_errors"] == []
+    assert stream["write_errors"] == []
+    assert stream["buffer_pool"].available() == 1
+
+
+def test_write_data_records_failed_read(stream):
+    assert _complete_read(stream, b"x" * 4096, errno.EIO) == 1
+    assert os.path.getsize(stream["path"]) == 0
+    assert stream["destination"]["written"] == []
+    assert stream["read_errors"] == [0]
+    assert stream["buffer_pool"].available() == 1
+
+
+def test_write_data_records_failed_write(stream):
+    # Writes to a read-only descriptor fail with EBADF
+    os.close(stream["destination"]["fd"])
+    stream["destination"]["fd"] = os.open(stream["path"], os.O_RDONLY)
+    assert _complete_read(stream, b"x" * 4096, 0) == 1
+    assert stream["destination"]["written"] == []
+    assert len(stream["write_errors"]) == 1
+    assert stream["write_errors"][0][0] == 0
+    assert stream["buffer_pool"].available() == 1
+    with pytest.raises(Exception, match="Destination write failed at offset 0 B"):
+        stream["vm_manager"]._raise_stream_errors(stream)